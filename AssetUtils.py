@@ -1,13 +1,467 @@
+import io
 import os
-import xlrd
-import requests
+import json
+import hashlib
+import random
+import bisect
 import pathlib
 import pandas as pd
 import numpy as np
 import logging
 import pickle
+import time
+import sqlite3
+import threading
+import functools
+import cProfile
+import pstats
+import weakref
+from contextlib import closing, contextmanager, nullcontext
 from datetime import datetime, date
-from bs4 import BeautifulSoup
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+class Instrumentation:
+
+    def __init__(self, callback = None):
+        # Every recorded value is aggregated per metric name; `callback`, if
+        # given, is also called as callback(name, value) for each of them.
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._profiles = {}
+
+    def record(self, name, value = 1):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric == None:
+                self._metrics[name] = {'count': 1, 'total': value, 'min': value, 'max': value}
+            else:
+                metric['count'] += 1
+                metric['total'] += value
+                metric['min'] = min(metric['min'], value)
+                metric['max'] = max(metric['max'], value)
+        if self.callback != None:
+            self.callback(name, value)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    @contextmanager
+    def profile(self, name, limit = 20):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream = stream).sort_stats('cumulative').print_stats(limit)
+            with self._lock:
+                self._profiles[name] = stream.getvalue()
+
+    def as_dict(self):
+        with self._lock:
+            return {'metrics': {name: dict(metric) for name, metric in self._metrics.items()},
+                    'profiles': dict(self._profiles)}
+
+    def reset(self):
+        with self._lock:
+            self._metrics = {}
+            self._profiles = {}
+
+_instrumentation = None
+
+def set_instrumentation(instrumentation):
+    global _instrumentation
+    previous = _instrumentation
+    _instrumentation = instrumentation
+    return previous
+
+def _record(name, value = 1):
+    if _instrumentation != None:
+        _instrumentation.record(name, value)
+
+def _timer(name):
+    if _instrumentation == None:
+        return nullcontext()
+    return _instrumentation.timer(name)
+
+def _timed(name):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if _instrumentation == None:
+                return method(*args, **kwargs)
+            with _instrumentation.timer(name):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class RequestScheduler:
+
+    retry_statuses = {429, 500, 502, 503, 504}
+
+    def __init__(self, timeout = (5, 30), retries = 4, backoff = 0.5, max_backoff = 30,
+                 rate = 10, burst = 20, max_concurrency = 16, min_concurrency = 1, latency_spike = 3):
+        # Requests to a host are limited to `rate` per second with bursts of
+        # `burst`. The number of requests in flight adapts between the two
+        # concurrency bounds: it grows by one per window of successful
+        # requests and halves on errors or on latencies `latency_spike` times
+        # above the running average. Failed requests are retried with
+        # exponential backoff and full jitter.
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.latency_spike = latency_spike
+        self._init_state()
+
+    def _init_state(self):
+        self._session = None
+        self._lock = threading.Lock()
+        self._slots = threading.Condition(self._lock)
+        self._buckets = {}
+        self._limit = float(self.max_concurrency)
+        self._active = 0
+        self._latency = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['_session', '_lock', '_slots', '_buckets', '_limit', '_active', '_latency']:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def _get_session(self):
+        import requests
+        with self._lock:
+            if self._session == None:
+                adapter = requests.adapters.HTTPAdapter(pool_connections = 4, pool_maxsize = self.max_concurrency)
+                self._session = requests.Session()
+                self._session.mount('http://', adapter)
+                self._session.mount('https://', adapter)
+            return self._session
+
+    def _take_token(self, host):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                tokens, last = self._buckets.get(host, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - last) * self.rate)
+                if tokens >= 1:
+                    self._buckets[host] = (tokens - 1, now)
+                    return
+                self._buckets[host] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+
+    def _acquire_slot(self):
+        with self._slots:
+            while self._active >= max(self.min_concurrency, int(self._limit)):
+                self._slots.wait()
+            self._active += 1
+
+    def _release_slot(self, latency, failed):
+        with self._slots:
+            self._active -= 1
+            spike = self._latency != None and latency > self.latency_spike * self._latency
+            if failed or spike:
+                self._limit = max(self.min_concurrency, self._limit / 2)
+            else:
+                self._limit = min(self.max_concurrency, self._limit + 1 / self._limit)
+            if not failed:
+                self._latency = latency if self._latency == None else 0.8 * self._latency + 0.2 * latency
+            self._slots.notify_all()
+
+    def _get_delay(self, attempt, r):
+        retry_after = None if r == None else r.headers.get('Retry-After')
+        if retry_after != None and retry_after.isdigit():
+            return min(self.max_backoff, int(retry_after))
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def get(self, url, **kwargs):
+        import requests
+        session = self._get_session()
+        host = urlparse(url).netloc
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            self._take_token(host)
+            self._acquire_slot()
+            start = time.perf_counter()
+            r = None
+            error = None
+            failed = True
+            try:
+                r = session.get(url, **kwargs)
+                failed = r.status_code in self.retry_statuses
+            except requests.RequestException as e:
+                error = e
+            finally:
+                # Also on errors that are not retried, or the slot is lost
+                latency = time.perf_counter() - start
+                self._release_slot(latency, failed)
+                _record('http.latency', latency)
+            if not failed:
+                return r
+            if r != None:
+                # A streamed response holds its pooled connection until closed
+                r.close()
+            if attempt < self.retries:
+                _record('http.retries')
+                logging.info('Request to %s failed (%s), retrying' % (url, error if r == None else r.status_code))
+                time.sleep(self._get_delay(attempt, r))
+        _record('http.errors')
+        if error != None:
+            raise error
+        raise requests.HTTPError('%d Server Error for url: %s' % (r.status_code, url), response = r)
+
+class PriceCache:
+
+    date_format = '%Y-%m-%d'
+
+    def __init__(self, path, ttl = pd.Timedelta(hours = 12), recent_days = 3):
+        # Ranges fetched more than `ttl` ago are trusted only up to
+        # `recent_days` before the fetch, since the latest quotes may
+        # still be missing or revised upstream.
+        self.path = str(path)
+        self.ttl = pd.Timedelta(ttl)
+        self.recent_days = recent_days
+        with closing(self._connect()) as con, con:
+            con.execute('CREATE TABLE IF NOT EXISTS prices '
+                        '(id TEXT, date TEXT, price REAL, PRIMARY KEY (id, date))')
+            con.execute('CREATE TABLE IF NOT EXISTS ranges '
+                        '(id TEXT, range_start TEXT, range_end TEXT, fetched TEXT)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout = 30)
+
+    def _format(self, date_):
+        return date_.strftime(self.date_format)
+
+    def covered(self, id, now = None):
+        if now == None:
+            now = pd.Timestamp.now()
+        with closing(self._connect()) as con:
+            rows = con.execute('SELECT range_start, range_end, fetched FROM ranges WHERE id = ?',
+                               (id,)).fetchall()
+        intervals = []
+        for range_start, range_end, fetched in rows:
+            range_start = pd.Timestamp(range_start)
+            range_end = pd.Timestamp(range_end)
+            fetched = pd.Timestamp(fetched)
+            if now - fetched >= self.ttl:
+                range_end = min(range_end, fetched.normalize() - pd.Timedelta(days = self.recent_days))
+            if range_start <= range_end:
+                intervals.append((range_start, range_end))
+        return sorted(intervals)
+
+    def missing(self, id, start_date, end_date, now = None):
+        start_date = pd.Timestamp(start_date).normalize()
+        end_date = pd.Timestamp(end_date).normalize()
+        gaps = []
+        cursor = start_date
+        for range_start, range_end in self.covered(id, now):
+            if range_start > end_date:
+                break
+            if range_end < cursor:
+                continue
+            if range_start > cursor:
+                gaps.append((cursor, range_start - pd.Timedelta(days = 1)))
+            cursor = range_end + pd.Timedelta(days = 1)
+        if cursor <= end_date:
+            gaps.append((cursor, end_date))
+        return gaps
+
+    def store(self, id, start_date, end_date, prices_df, fetched = None):
+        if fetched == None:
+            fetched = pd.Timestamp.now()
+        prices_df = prices_df.dropna(subset = ['date'])
+        rows = [(id, self._format(d), float(p)) for d, p in zip(prices_df['date'], prices_df['price'])]
+        start_date = pd.Timestamp(start_date).normalize()
+        end_date = pd.Timestamp(end_date).normalize()
+        with closing(self._connect()) as con, con:
+            con.execute('DELETE FROM prices WHERE id = ? AND date BETWEEN ? AND ?',
+                        (id, self._format(start_date), self._format(end_date)))
+            con.executemany('INSERT OR REPLACE INTO prices VALUES (?, ?, ?)', rows)
+            ranges = con.execute('SELECT rowid, range_start, range_end, fetched FROM ranges WHERE id = ?',
+                                 (id,)).fetchall()
+            start_date, end_date, merged = self._merge_ranges(start_date, end_date, fetched, ranges)
+            con.executemany('DELETE FROM ranges WHERE rowid = ?', [(rowid,) for rowid in merged])
+            con.execute('INSERT INTO ranges VALUES (?, ?, ?, ?)',
+                        (id, self._format(start_date), self._format(end_date), fetched.isoformat()))
+
+    def _merge_ranges(self, start_date, end_date, fetched, ranges):
+        # Ranges overlapping or next to the new one are merged into it, so
+        # that an id keeps a row or two. The merged range takes the new
+        # fetch time, so a range is merged only if it has no recent days or
+        # the new one fetched them again; otherwise they would be trusted
+        # for longer than `recent_days` allows.
+        day = pd.Timedelta(days = 1)
+        fetched_start, fetched_end = start_date, end_date
+        merged = []
+        changed = True
+        while changed:
+            changed = False
+            for rowid, range_start, range_end, range_fetched in ranges:
+                range_start = pd.Timestamp(range_start)
+                range_end = pd.Timestamp(range_end)
+                range_fetched = pd.Timestamp(range_fetched)
+                settled = range_fetched.normalize() - pd.Timedelta(days = self.recent_days)
+                if rowid in merged or range_fetched > fetched:
+                    continue
+                if range_start > end_date + day or range_end < start_date - day:
+                    continue
+                if range_end > settled and not (fetched_start <= max(range_start, settled + day) and
+                                                range_end <= fetched_end):
+                    continue
+                start_date = min(start_date, range_start)
+                end_date = max(end_date, range_end)
+                merged.append(rowid)
+                changed = True
+        return start_date, end_date, merged
+
+    def load(self, id, start_date, end_date):
+        with closing(self._connect()) as con:
+            rows = con.execute('SELECT date, price FROM prices WHERE id = ? AND date BETWEEN ? AND ? '
+                               'ORDER BY date DESC',
+                               (id, self._format(start_date), self._format(end_date))).fetchall()
+        prices_df = pd.DataFrame(rows, columns = ['date', 'price'])
+        prices_df['date'] = pd.to_datetime(prices_df['date'], format = self.date_format)
+        prices_df['price'] = prices_df['price'].astype(float)
+        return prices_df
+
+    def get(self, id, start_date, end_date, fetch):
+        now = pd.Timestamp.now()
+        start_date = pd.Timestamp(start_date).normalize()
+        end_date = pd.Timestamp(end_date).normalize()
+        for gap_start, gap_end in self.missing(id, start_date, end_date, now):
+            prices_df = fetch(id, gap_start, gap_end)
+            if prices_df is None:
+                return None
+            self.store(id, gap_start, gap_end, prices_df, now)
+            logging.info('Prices of "%s" fetched from %s to %s' % (id, gap_start, gap_end))
+        return self.load(id, start_date, end_date)
+
+    def invalidate(self, id = None, since = None):
+        where = ''
+        params = ()
+        if id != None:
+            where = ' AND id = ?'
+            params = (id,)
+        since = '' if since == None else self._format(pd.Timestamp(since))
+        with closing(self._connect()) as con, con:
+            con.execute('DELETE FROM prices WHERE date >= ?' + where, (since,) + params)
+            con.execute('DELETE FROM ranges WHERE range_start >= ?' + where, (since,) + params)
+            if since != '':
+                last_kept = self._format(pd.Timestamp(since) - pd.Timedelta(days = 1))
+                con.execute('UPDATE ranges SET range_end = ? WHERE range_end >= ?' + where,
+                            (last_kept, since) + params)
+
+class AssetSearchIndex:
+
+    gram_size = 3
+    regex_chars = set('.^$*+?{}[]\\|()')
+
+    def __init__(self, db = None):
+        # Every lowercase 1..gram_size-gram of a row maps to the set of row ids
+        # containing it. Searches read sorted arrays of row positions, built
+        # per gram on first use; candidates for tokens longer than gram_size
+        # are then checked with a substring test on the row's values joined
+        # by a separator.
+        self._grams = {}
+        self._values = {}
+        self._ids = []
+        self._positions = {}
+        self._postings = {}
+        if db is not None:
+            for id, values in zip(db.index, db.astype(str).itertuples(index = False)):
+                self.add(id, values)
+            self.set_order(db.index)
+
+    separator = '\x00'
+
+    def set_order(self, ids):
+        # Row order of the catalogue that positions refer to
+        self._ids = list(ids)
+        self._positions = {id: i for i, id in enumerate(self._ids)}
+        self._postings = {}
+
+    def _get_grams(self, text, sizes):
+        grams = set()
+        for n in sizes:
+            grams.update(text[i:i + n] for i in range(len(text) - n + 1))
+        return grams
+
+    def add(self, id, values):
+        if id in self._values:
+            self.remove(id)
+        elif id not in self._positions:
+            self._positions[id] = len(self._ids)
+            self._ids.append(id)
+        values = ['' if pd.isna(value) else str(value).lower() for value in values]
+        self._values[id] = self.separator.join(values)
+        for value in values:
+            for gram in self._get_grams(value, range(1, self.gram_size + 1)):
+                self._grams.setdefault(gram, set()).add(id)
+        self._postings = {}
+
+    def remove(self, id):
+        # The row keeps its position until set_order is called again
+        grams = set()
+        for value in self._values.pop(id).split(self.separator):
+            grams.update(self._get_grams(value, range(1, self.gram_size + 1)))
+        for gram in grams:
+            ids = self._grams[gram]
+            ids.discard(id)
+            if len(ids) == 0:
+                del self._grams[gram]
+        self._postings = {}
+
+    def _get_positions(self, ids):
+        positions = np.fromiter((self._positions[id] for id in ids), dtype = np.int64, count = len(ids))
+        positions.sort()
+        return positions
+
+    def _get_posting(self, gram):
+        posting = self._postings.get(gram)
+        if posting is None:
+            posting = self._get_positions(self._grams.get(gram, ()))
+            self._postings[gram] = posting
+        return posting
+
+    def supports(self, token):
+        return len(self.regex_chars.intersection(token)) == 0
+
+    def search(self, token):
+        # Sorted row positions of the rows containing token
+        token = token.lower()
+        if len(token) == 0:
+            return self._get_positions(self._values.keys())
+        if len(token) <= self.gram_size:
+            return self._get_posting(token)
+        postings = sorted((self._get_posting(gram) for gram in self._get_grams(token, [self.gram_size])), key = len)
+        positions = postings[0]
+        for posting in postings[1:]:
+            # Few candidates are cheaper to check than a long posting to intersect
+            if len(positions) * 16 <= len(posting):
+                break
+            positions = np.intersect1d(positions, posting, assume_unique = True)
+        values = self._values
+        ids = self._ids
+        return positions[[token in values[ids[i]] for i in positions.tolist()]]
 
 class AssetDatabase:
 
@@ -16,65 +470,265 @@ class AssetDatabase:
     domains     = {'etf': 'http://world.investfunds.ru/etf',
                    'pif': 'http://pif.investfunds.ru/funds'}
     time_format = '%d.%m.%Y'
+    download_chunk_size = 64 * 1024
+    db_formats  = ['csv', 'feather']
+    # Arrow IPC files (Feather v2) and Feather v1 files start with these
+    feather_magic = [b'ARROW1', b'FEA1']
 
-    def __init__(self):
+    def __init__(self, search_index = False):
         self._db = pd.DataFrame(columns = self.db_columns)
+        self.price_cache = None
+        self.search_index = search_index
+        self._index = None
+        self._page_state = {}
+        # Created here rather than on first request, so that crawl threads
+        # share a single scheduler
+        self.scheduler = RequestScheduler()
+
+    def __setstate__(self, state):
+        # Databases pickled before the scheduler was added
+        self.__dict__.update(state)
+        if getattr(self, 'scheduler', None) == None:
+            self.scheduler = RequestScheduler()
+
+    @_timed('parse.table')
+    def _extract_table(self, content, table_id = 'funds_table'):
+        # Only the table itself is built into a tree. Rows are returned as
+        # tuples of (cell string, link string, link href) per <td>, with an
+        # empty tuple for header rows, or None if there is no such table.
+        from bs4 import BeautifulSoup, SoupStrainer
+        strainer = SoupStrainer('table', id = table_id)
+        table = BeautifulSoup(content, 'html.parser', parse_only = strainer).find('table', id = table_id)
+        if table == None:
+            return None
+        text = lambda string: None if string == None else str(string)
+        rows = []
+        for tr in table.find_all('tr'):
+            cells = []
+            for td in tr.find_all('td'):
+                a = td.a
+                if a == None:
+                    cells.append((text(td.string), None, None))
+                else:
+                    cells.append((text(td.string), text(a.string), a['href']))
+            rows.append(tuple(cells))
+        return rows
 
-    def retrieve_database(self):
-        new_db = pd.DataFrame(columns = self.db_columns)
-        print('Retrieving database...')
+    def _parse_listing_page(self, content, asset_type):
         web_table_columns = { 'etf': { 'name': 0, 'exchange': 1, 'ticker': 2 },
                               'pif': { 'name': 0 } }
-        web_page_token    = { 'etf': '/?p=',
-                              'pif': '/?exclude_qualified=1&npage=' }
         empty_table_size = 2
-        for asset_type in self.asset_types:
-            page = 0
-            while True:
-                web_page = self.domains[asset_type] + web_page_token[asset_type] + str(page)
-                r = requests.get(web_page)
-                soup = BeautifulSoup(r.content, 'html.parser')
-                asset_table = soup.find('table', id = 'funds_table')
-                if asset_table == None:
-                    break
-                tr = asset_table.find_all('tr')
-                if len(tr) <= empty_table_size:
-                    break
-                for elem in tr:
-                    names = elem.find_all('td')
-                    if len(names) != 0:
-                        if asset_type == 'etf':
-                            href = names[web_table_columns[asset_type]['name']].a['href'].split('/')[-2]
-                            data = [names[web_table_columns[asset_type]['name']].string,
-                                    names[web_table_columns[asset_type]['exchange']].string,
-                                    names[web_table_columns[asset_type]['ticker']].string,
-                                    href,
-                                    asset_type]
-                        elif asset_type == 'pif':
-                            href = names[web_table_columns[asset_type]['name']].a['href'].split('/')[-1]
-                            data = [names[web_table_columns[asset_type]['name']].a.string,
-                                    float('nan'),
-                                    float('nan'),
-                                    href,
-                                    asset_type]
-                        id = str(asset_type + str(href))
-                        new_db = new_db.append(pd.Series(data, index = self._db.columns, name = id))
-                page += 1
-
-        self._db = new_db
+        tr = self._extract_table(content)
+        if tr == None or len(tr) <= empty_table_size:
+            return None
+        rows = []
+        for names in tr:
+            if len(names) != 0:
+                if asset_type == 'etf':
+                    href = names[web_table_columns[asset_type]['name']][2].split('/')[-2]
+                    data = [names[web_table_columns[asset_type]['name']][0],
+                            names[web_table_columns[asset_type]['exchange']][0],
+                            names[web_table_columns[asset_type]['ticker']][0],
+                            href,
+                            asset_type]
+                elif asset_type == 'pif':
+                    href = names[web_table_columns[asset_type]['name']][2].split('/')[-1]
+                    data = [names[web_table_columns[asset_type]['name']][1],
+                            float('nan'),
+                            float('nan'),
+                            href,
+                            asset_type]
+                id = str(asset_type + str(href))
+                rows.append((id, data))
+        return rows
+
+    def _retrieve_listing_page(self, asset_type, page, old_states, new_states):
+        # Pages whose ETag, Last-Modified or content hash match the previous
+        # crawl are not parsed again; their rows are taken from the catalogue.
+        web_page_token = { 'etf': '/?p=',
+                           'pif': '/?exclude_qualified=1&npage=' }
+        web_page = self.domains[asset_type] + web_page_token[asset_type] + str(page)
+        key = (asset_type, page)
+        state = old_states.get(key)
+        if state != None and state['ids'] != None and not all(id in self._db.index for id in state['ids']):
+            state = None
+        headers = {}
+        if state != None:
+            if state['etag'] != None:
+                headers['If-None-Match'] = state['etag']
+            if state['last_modified'] != None:
+                headers['If-Modified-Since'] = state['last_modified']
+        r = self._request(web_page, headers = headers)
+        _record('crawl.pages')
+        if r.status_code == 304 and state != None:
+            digest = state['hash']
+        else:
+            digest = hashlib.sha1(r.content).hexdigest()
+        if state != None and digest == state['hash']:
+            new_states[key] = state
+            if state['ids'] == None:
+                return None
+            return list(zip(state['ids'], self._db.loc[state['ids'], self.db_columns].values.tolist())), False
+        rows = self._parse_listing_page(r.content, asset_type)
+        _record('crawl.rows', 0 if rows == None else len(rows))
+        new_states[key] = { 'etag': r.headers.get('ETag'),
+                            'last_modified': r.headers.get('Last-Modified'),
+                            'hash': digest,
+                            'ids': None if rows == None else [id for id, data in rows] }
+        if rows == None:
+            return None
+        return rows, True
+
+    def _request(self, url, **kwargs):
+        import requests
+        r = self.scheduler.get(url, **kwargs)
+        # Error pages must not be taken for empty listings or histories
+        if not (200 <= r.status_code < 300 or r.status_code == 304):
+            raise requests.HTTPError('%d Error for url: %s' % (r.status_code, url), response = r)
+        if not kwargs.get('stream', False):
+            _record('http.bytes', len(r.content))
+        return r
+
+    def _crawl_listing(self, executor, fetch, asset_type, workers):
+        # Pages are requested in batches of `workers`; anything past the
+        # first empty page of a batch is discarded, so the result does not
+        # depend on the number of workers.
+        page = 0
+        while True:
+            batch = executor.map(lambda p: fetch(asset_type, p), range(page, page + workers))
+            for result in batch:
+                if result == None:
+                    return
+                yield result
+            page += workers
+
+    def _crawl_database(self, workers, old_states):
+        if workers < 1:
+            raise ValueError('Number of workers should be positive')
+        new_states = {}
+        ids = []
+        seen = set()
+        fetched_ids = []
+        columns = [[] for _ in self.db_columns]
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            fetch = lambda asset_type, page: self._retrieve_listing_page(asset_type, page, old_states, new_states)
+            for asset_type in self.asset_types:
+                for rows, fetched in self._crawl_listing(executor, fetch, asset_type, workers):
+                    for id, data in rows:
+                        # A fund listed during the crawl shifts the later
+                        # pages, so rows can repeat; the first one is kept
+                        if id in seen:
+                            continue
+                        seen.add(id)
+                        ids.append(id)
+                        if fetched:
+                            fetched_ids.append(id)
+                        for column, value in zip(columns, data):
+                            column.append(value)
+
+        new_db = pd.DataFrame(dict(zip(self.db_columns, columns)), index = ids,
+                              columns = self.db_columns)
+        return new_db, fetched_ids, new_states
+
+    @_timed('database.retrieve')
+    def retrieve_database(self, workers = 1):
+        print('Retrieving database...')
+        self._db, _, self._page_state = self._crawl_database(workers, {})
+        self._update_search_index()
         print('Success!')
 
-    def save_database(self, name):
-        self._db.to_csv('%s.csv' % name, encoding = 'utf-8')
+    @_timed('database.sync')
+    def sync_database(self, workers = 1):
+        # A failed crawl raises before anything is replaced
+        old_db = self._db
+        new_db, fetched_ids, page_state = self._crawl_database(workers, getattr(self, '_page_state', {}))
+
+        added = new_db.index[~new_db.index.isin(old_db.index)].tolist()
+        removed = old_db.index[~old_db.index.isin(new_db.index)].tolist()
+        common = new_db.index[new_db.index.isin(fetched_ids) & new_db.index.isin(old_db.index)]
+        differs = (new_db.loc[common, self.db_columns].astype(str).fillna('').values !=
+                   old_db.loc[common, self.db_columns].astype(str).fillna('').values).any(axis = 1)
+        changed = common[differs].tolist()
 
-    def load_database(self, name):
-        new_db = pd.read_csv('%s.csv' % name, index_col = 0)
+        self._db = new_db
+        self._page_state = page_state
+        index = getattr(self, '_index', None)
+        if index != None:
+            for id in removed:
+                index.remove(id)
+            for id in added + changed:
+                index.add(id, new_db.loc[id, self.db_columns])
+            index.set_order(new_db.index)
+        logging.info('Database synced: %d added, %d removed, %d changed' % (len(added), len(removed), len(changed)))
+        return {'added': added, 'removed': removed, 'changed': changed}
+
+    def save_database(self, name, format = 'csv'):
+        if format == 'csv':
+            self._db.to_csv('%s.csv' % name, encoding = 'utf-8')
+        elif format == 'feather':
+            # Uncompressed so that the snapshot can be memory-mapped without
+            # copies; the ids are stored as the frame's index
+            from pyarrow import feather
+            db = self._db.astype({'exchange': 'category', 'type': 'category'})
+            db.index.name = 'id'
+            feather.write_feather(db, '%s.feather' % name, compression = 'uncompressed')
+        else:
+            raise ValueError('Unknown database format: %s' % format)
+
+    def _get_snapshot_path(self, name, format):
+        # `name` is the path of a snapshot or the name it was saved under;
+        # a name saved in both formats needs the format to load
+        if format != None:
+            if format not in self.db_formats:
+                raise ValueError('Unknown database format: %s' % format)
+            return '%s.%s' % (name, format)
+        if os.path.isfile(name):
+            return name
+        paths = [path for path in ['%s.%s' % (name, extension) for extension in self.db_formats]
+                 if os.path.exists(path)]
+        if len(paths) > 1:
+            raise ValueError('Database %s is saved as both csv and feather, the format should be given' % name)
+        return paths[0] if len(paths) != 0 else '%s.csv' % name
+
+    def _is_feather(self, path):
+        with open(path, 'rb') as f:
+            head = f.read(6)
+        return any(head.startswith(magic) for magic in self.feather_magic)
+
+    def load_database(self, name, format = None):
+        path = self._get_snapshot_path(name, format)
+        if self._is_feather(path):
+            from pyarrow import feather
+            table = feather.read_table(path, memory_map = True)
+            if table.column_names != self.db_columns + ['id']:
+                raise ValueError('Wrong database file')
+            new_db = table.to_pandas()
+            new_db.index.name = None
+        else:
+            new_db = pd.read_csv(path, index_col = 0)
         if len(set(new_db.columns).difference(self.db_columns)) != 0:
             raise ValueError('Wrong database file')
         else:
             self._db = new_db
+            self._update_search_index()
+
+    def build_search_index(self):
+        self.search_index = True
+        self._index = AssetSearchIndex(self._db)
+
+    def _update_search_index(self):
+        # Rebuilt on the next find, so that loading a catalogue stays fast
+        self._index = None
+
+    def _get_search_index(self):
+        if getattr(self, '_index', None) == None and getattr(self, 'search_index', False):
+            self._index = AssetSearchIndex(self._db)
+        return getattr(self, '_index', None)
 
     def find(self, token):
+        index = self._get_search_index()
+        if index != None and index.supports(token):
+            return self._db.iloc[index.search(token)]
         mask = np.column_stack([self._db[col].astype(str).str.contains(token, case = False,
                                                    na = False) for col in self._db.columns])
         return self._db.iloc[mask.any(axis = 1)]
@@ -93,6 +747,12 @@ class AssetDatabase:
             return False
 
     def retrieve_asset_historical(self, id, start_date, end_date):
+        price_cache = getattr(self, 'price_cache', None)
+        if price_cache == None:
+            return self._download_asset_historical(id, start_date, end_date)
+        return price_cache.get(id, start_date, end_date, self._download_asset_historical)
+
+    def _download_asset_historical(self, id, start_date, end_date):
         hist_columns = ['date', 'price']
         start_date_str = start_date.strftime(self.time_format)
         end_date_str = end_date.strftime(self.time_format)
@@ -104,32 +764,38 @@ class AssetDatabase:
             stats_page_href = '/stats'
             stats_page_table = { 'date' : 0, 'price' : 4 }
             empty_table_size = 2
+            dates = []
+            prices = []
             page = 0
             while True:
                 href = '%s/%s' % (self.domains[asset_type], asset_href)
                 params = { 'dateStart': start_date_str,
                            'dateEnd': end_date_str,
                            'p': page }
-                r = requests.get(href + stats_page_href, params = params)
-                soup = BeautifulSoup(r.content, 'html.parser')
-                stats_table = soup.find('table', id = 'funds_table')
-                tr = stats_table.find_all('tr')
+                r = self._request(href + stats_page_href, params = params)
+                _record('history.pages')
+                tr = self._extract_table(r.content)
+                if tr == None:
+                    # An error page rather than the end of the history; a
+                    # partial history must not be returned, or cached
+                    raise IOError('Page %d of "%s" history has no price table' % (page, id))
                 if len(tr) <= empty_table_size:
                     break
-                for elem in tr:
-                    names = elem.find_all('td')
+                for names in tr:
                     if len(names) != 0:
-                        date = names[stats_page_table['date']].string
-                        last_price_and_curr = names[stats_page_table['price']].string
+                        date = names[stats_page_table['date']][0]
+                        last_price_and_curr = names[stats_page_table['price']][0]
                         if len(last_price_and_curr) > 1:
                             split = last_price_and_curr.split()
                             price_string = (''.join(split[:-1])).replace(' ', '')
                             last_price = float(price_string)
                         else:
                             last_price = float('nan')
-                        data = [date, last_price]
-                        stats_df = stats_df.append(pd.Series(data, index = hist_columns), ignore_index = True)
+                        dates.append(date)
+                        prices.append(last_price)
                 page += 1
+            stats_df = pd.DataFrame({'date': dates, 'price': prices}, columns = hist_columns)
+            _record('history.rows', len(stats_df))
 
         elif asset_type == 'pif':
             export_page_href = self.domains[asset_type] + '/export_to_excel.php'
@@ -142,72 +808,369 @@ class AssetDatabase:
                        'finish_day' : end_date.day,
                        'finish_month' : end_date.month,
                        'finish_year' : end_date.year }
-            r = requests.get(export_page_href, params = params, stream = True)
-            if (r.status_code == 200) & (len(r.text) != 0):
-                with open('_temp.xls', 'wb') as f:
-                    for chunk in r.iter_content(1024):
-                        f.write(chunk)
-            else:
+            r = self._request(export_page_href, params = params, stream = True)
+            content = b''
+            if r.status_code == 200:
+                content = b''.join(r.iter_content(self.download_chunk_size))
+            _record('http.bytes', len(content))
+            if len(content) == 0:
                 print('Download error')
                 return None
-            wb = xlrd.open_workbook('_temp.xls', logfile = open(os.devnull, 'w'))
-            stats_df = pd.concat([stats_df, pd.read_excel(wb, engine = 'xlrd', skiprows = 3, header = None,
-                                            names = ['date', 'price'], parse_cols = 1)])
-            os.remove('_temp.xls')
+            import xlrd
+            with _timer('parse.excel'):
+                wb = xlrd.open_workbook(file_contents = content, logfile = io.StringIO())
+                stats_df = pd.read_excel(wb, engine = 'xlrd', skiprows = 3, header = None,
+                                         names = hist_columns, usecols = [0, 1])
+            _record('history.rows', len(stats_df))
         stats_df['date'] = pd.to_datetime(stats_df['date'], format = self.time_format)
 
         return stats_df
 
-class Asset:
+class PriceSeries:
 
-    def __init__(self, id, db, start_date = '1970-01-01'):
-        self.last_updated = pd.to_datetime(start_date) - pd.Timedelta(days = 1)
-        self._db = db
+    def __init__(self, id, db, start_date = '1970-01-01', description = None):
         self.id = id
-        self.description =  self._db.get_entry(self.id)
-        self.name, self.ticker = self.description.loc[['name', 'ticker']]
-        self.stats = pd.DataFrame(columns = ['count'])
-
+        self._db = db
+        if description is None:
+            description = self._db.get_entry(self.id)
+        self.description = description
+        self.start_date = pd.to_datetime(start_date)
+        self.last_updated = self.start_date - pd.Timedelta(days = 1)
+        # Daily prices from first_date to last_updated are stored as change
+        # points: the days (int64 ns) on which the price differs from the day
+        # before and the new prices. The first day is always a change point.
+        self.first_date = None
+        self._dates = np.zeros(0, dtype = np.int64)
+        self._prices = np.zeros(0, dtype = np.float64)
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        stats = state.pop('stats', None)
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        if stats is not None:
+            # Pickled with one row per day
+            self.set_daily(stats)
+
+    def __len__(self):
+        return len(self._dates)
+
+    @property
+    def nbytes(self):
+        return self._dates.nbytes + self._prices.nbytes
+
+    def _changes(self, days, prices, last_price = None):
+        # Without a last price the first day starts the series
+        previous = np.append(np.nan if last_price is None else last_price, prices[:-1])
+        same = (prices == previous) | (np.isnan(prices) & np.isnan(previous))
+        if last_price is None:
+            same[:1] = False
+        return days[~same], prices[~same]
+
+    def set_daily(self, stats):
+        # Replaces the prices with a daily 'price' frame
+        if len(stats) == 0:
+            self.first_date = None
+            self._dates = np.zeros(0, dtype = np.int64)
+            self._prices = np.zeros(0, dtype = np.float64)
+        else:
+            days = pd.DatetimeIndex(stats.index).as_unit('ns').asi8
+            prices = stats['price'].to_numpy(dtype = np.float64)
+            self.first_date = pd.Timestamp(days[0])
+            self._dates, self._prices = self._changes(days, prices)
+        self._version += 1
+
+    def get_dates(self):
+        if self.first_date is None:
+            return pd.DatetimeIndex([])
+        return pd.date_range(self.first_date, self.last_updated)
+
+    def get_prices(self, dates):
+        # As-of lookup; days outside first_date..last_updated are NaN
+        days = pd.DatetimeIndex(dates).as_unit('ns').asi8
+        pos = self._dates.searchsorted(days, side = 'right') - 1
+        prices = np.append(self._prices, np.nan)[pos]
+        if self.first_date is not None:
+            prices[days > self.last_updated.value] = np.nan
+        return prices
+
+    @property
+    def stats(self):
+        # One row per day, as prices were stored before
+        dates = self.get_dates()
+        return pd.DataFrame({'price': self.get_prices(dates)}, index = dates)
+
+    def extend(self, start_date):
+        # A portfolio created earlier than the series start; the whole history
+        # is fetched again on the next update.
+        start_date = pd.to_datetime(start_date)
+        with self._lock:
+            if start_date < self.start_date:
+                self.start_date = start_date
+
+    @_timed('asset.update')
     def update(self):
-        today = pd.to_datetime(date.today())
-        if today != self.last_updated:
-            date_range = pd.date_range(start = self.last_updated + pd.Timedelta(days = 1), end = today)
-
-            if len(self.stats) == 0:
-                init_value = 0
+        # Concurrent updates wait for the one in progress and then find the
+        # series up to date, so each asset is fetched once.
+        with self._lock:
+            today = pd.to_datetime(date.today())
+            dates = self._dates
+            prices = self._prices
+            last_updated = self.last_updated
+            if self.first_date is not None and self.first_date > self.start_date:
+                dates = dates[:0]
+                prices = prices[:0]
+                last_updated = self.start_date - pd.Timedelta(days = 1)
+            if today == last_updated:
+                logging.info('Asset "%s" is up date' % self.id)
+                return False
+            date_range = pd.date_range(start = last_updated + pd.Timedelta(days = 1), end = today)
+
+            prices_df = self._db.retrieve_asset_historical(self.id, last_updated, today)
+            if prices_df is None:
+                raise IOError('Prices of "%s" could not be downloaded' % self.id)
+
+            # Upstream returns quotes newest-first; a stable sort keeps the
+            # first listed quote of a date, as the row-by-row scan did.
+            prices_df = prices_df.dropna(subset = ['date'])
+            prices_df = prices_df.sort_values('date', kind = 'mergesort').drop_duplicates('date')
+            quote_dates = pd.DatetimeIndex(prices_df['date'])
+            quote_prices = prices_df['price'].to_numpy(dtype = float)
+            pos = quote_dates.searchsorted(date_range, side = 'right') - 1
+            if (pos < 0).any():
+                # Days before the first quote index -1 and keep the last known
+                # price, or NaN for a new asset whose history starts later
+                quote_prices = np.append(quote_prices, prices[-1] if len(prices) != 0 else np.nan)
+            daily_prices = quote_prices[pos]
+
+            last_price = None
+            if len(dates) == 0:
+                self.first_date = date_range[0]
             else:
-                init_value = self.stats.iloc[-1][0]
+                last_price = prices[-1]
+            new_dates, new_prices = self._changes(date_range.as_unit('ns').asi8, daily_prices, last_price)
+            self._dates = np.concatenate([dates, new_dates])
+            self._prices = np.concatenate([prices, new_prices])
+            self._version += 1
+            logging.info('Asset "%s" updated from %s' % (self.id, last_updated))
+            self.last_updated = today
+            return True
 
-            stats_df = pd.DataFrame(init_value, index = date_range, columns = ['count'])
-            prices_df = self._db.retrieve_asset_historical(self.id, self.last_updated, today)
+class AssetRegistry:
 
-            price = []
-            for s in date_range:
-                prices = prices_df[prices_df['date'] <= s]
-                if len(prices) != 0:
-                    price.append(prices.iloc[0]['price'])
-                else:
-                    price.append(self.stats.iloc[-1]['price'])
+    def __init__(self):
+        # One price series per asset id shared by all portfolios of the
+        # process; series no portfolio refers to any more are dropped.
+        self._series = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def get(self, id, db, start_date = '1970-01-01', description = None):
+        with self._lock:
+            series = self._series.get(id)
+            if series == None:
+                series = PriceSeries(id, db, start_date, description)
+                self._series[id] = series
+        series.extend(start_date)
+        return series
+
+    def __contains__(self, id):
+        return id in self._series
+
+    def __len__(self):
+        return len(self._series)
+
+    @_timed('registry.update_all')
+    def update_all(self, portfolios, workers = 1):
+        # The union of the assets of all outdated portfolios is updated once
+        today = pd.to_datetime(date.today())
+        portfolios = [portfolio for portfolio in portfolios if portfolio.last_updated != today]
+        assets = {}
+        for portfolio in portfolios:
+            for asset in portfolio.asset_list:
+                assets.setdefault(id(asset.series), asset)
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            report = list(executor.map(_update_asset, assets.values()))
+        for portfolio in portfolios:
+            portfolio._finish_update(report, today)
+        return pd.DataFrame(report, columns = ['id', 'status', 'time', 'error'])
+
+_registry = None
+
+def set_registry(registry):
+    global _registry
+    previous = _registry
+    _registry = registry
+    return previous
+
+def _update_asset(asset):
+    start = time.perf_counter()
+    error = ''
+    try:
+        status = 'updated' if asset.update() else 'up to date'
+    except Exception as e:
+        status = 'error'
+        error = repr(e)
+        logging.warning('Asset %s update failed: %s' % (asset.id, error))
+    return [asset.id, status, time.perf_counter() - start, error]
 
-            stats_df['price'] = pd.Series(price, index = date_range)
+class Asset:
 
-            self.stats = self.stats.append(stats_df)
-            logging.info('Asset "%s" updated from %s' % (self.id, self.last_updated))
-            self.last_updated = today
+    def __init__(self, id, db, start_date = '1970-01-01', description = None):
+        # Prices live in a PriceSeries, shared through the registry when one
+        # is set; the trade ledger belongs to this asset only.
+        if _registry != None:
+            self.series = _registry.get(id, db, start_date, description)
         else:
-            logging.info('Asset "%s" is up date' % self.id)
+            self.series = PriceSeries(id, db, start_date, description)
+        self.id = id
+        self.description = self.series.description
+        self.name, self.ticker = self.description['name'], self.description['ticker']
+        # Holdings are a ledger of trades sorted by date; counts are the
+        # cumulative sums, recomputed lazily from the first changed trade in
+        # a buffer that grows by doubling, so appending trades is amortized
+        # O(1). The date index of the ledger is built on the next lookup.
+        self._trade_dates = []
+        self._trade_counts = []
+        self._holdings = np.zeros(0)
+        self._holdings_valid = 0
+        self._trade_index = None
+        self._version = 0
+
+    def __setstate__(self, state):
+        if '_trade_dates' not in state:
+            # Pickled before the trade ledger: holdings were a daily 'count'
+            # column, every change of which becomes a trade
+            stats = state['stats']
+            counts = stats['count'].to_numpy(dtype = float) if 'count' in stats else np.zeros(len(stats))
+            deltas = np.diff(counts, prepend = 0)
+            changed = np.flatnonzero(deltas != 0)
+            state['_trade_dates'] = list(stats.index[changed])
+            state['_trade_counts'] = deltas[changed].tolist()
+        state.setdefault('_holdings', np.zeros(0))
+        state.setdefault('_holdings_valid', 0)
+        state.setdefault('_trade_index', None)
+        state.setdefault('_version', 0)
+        if 'series' not in state:
+            # Pickled before prices moved to PriceSeries
+            stats = state.pop('stats')
+            last_updated = state.pop('last_updated')
+            series = PriceSeries.__new__(PriceSeries)
+            series.__setstate__({'id': state['id'], '_db': state.pop('_db'),
+                                 'description': state['description'],
+                                 'start_date': stats.index[0] if len(stats) != 0 else last_updated + pd.Timedelta(days = 1),
+                                 'last_updated': last_updated, 'stats': stats, '_version': 0})
+            state['series'] = series
+        self.__dict__.update(state)
+
+    @property
+    def stats(self):
+        return self.series.stats
+
+    @stats.setter
+    def stats(self, stats):
+        self.series.set_daily(stats)
+
+    @property
+    def last_updated(self):
+        return self.series.last_updated
+
+    @last_updated.setter
+    def last_updated(self, last_updated):
+        self.series.last_updated = last_updated
+
+    def update(self):
+        return self.series.update()
+
+    def _invalidate_holdings(self, i):
+        self._holdings_valid = min(self._holdings_valid, i)
+        self._trade_index = None
+        self._version += 1
+
+    def _get_holdings(self):
+        n = len(self._trade_counts)
+        valid = self._holdings_valid
+        if valid < n:
+            if len(self._holdings) < n:
+                holdings = np.zeros(max(n, 2 * len(self._holdings)))
+                holdings[:valid] = self._holdings[:valid]
+                self._holdings = holdings
+            start = self._holdings[valid - 1] if valid > 0 else 0
+            self._holdings[valid:n] = start + np.cumsum(self._trade_counts[valid:])
+            self._holdings_valid = n
+        return self._holdings[:n]
+
+    def _check_holdings(self, i):
+        # Holdings before trade i are unchanged
+        return not (self._get_holdings()[i:] < 0).any()
+
+    def _set_ledger(self, dates, counts):
+        # Replaces the ledger in one pass; trades of a day keep their order
+        dates = np.asarray(dates, dtype = np.int64)
+        order = np.argsort(dates, kind = 'stable')
+        index = pd.DatetimeIndex(dates[order])
+        self._trade_dates = list(index)
+        self._trade_counts = np.asarray(counts, dtype = float)[order].tolist()
+        self._invalidate_holdings(0)
+        if not self._check_holdings(0):
+            raise ValueError("Asset count couldn't be less than zero")
+        self._trade_index = index
 
     def add(self, date_, count):
-        for idx in self.stats.index[self.stats.index >= date_]:
-            self.stats.loc[idx, 'count'] += count
-            if self.stats.loc[idx, 'count'] < 0:
-                raise ValueError("Asset count couldn't be less than zero")
+        date_ = pd.to_datetime(date_)
+        i = bisect.bisect_right(self._trade_dates, date_)
+        self._trade_dates.insert(i, date_)
+        self._trade_counts.insert(i, count)
+        self._invalidate_holdings(i)
+        if not self._check_holdings(i):
+            self._trade_dates.pop(i)
+            self._trade_counts.pop(i)
+            self._invalidate_holdings(i)
+            raise ValueError("Asset count couldn't be less than zero")
+
+    def remove(self, date_, count):
+        date_ = pd.to_datetime(date_)
+        lo = bisect.bisect_left(self._trade_dates, date_)
+        hi = bisect.bisect_right(self._trade_dates, date_)
+        if count not in self._trade_counts[lo:hi]:
+            raise LookupError('Trade is not in the asset ledger')
+        i = lo + self._trade_counts[lo:hi].index(count)
+        self._trade_dates.pop(i)
+        self._trade_counts.pop(i)
+        self._invalidate_holdings(i)
+        if not self._check_holdings(i):
+            self._trade_dates.insert(i, date_)
+            self._trade_counts.insert(i, count)
+            self._invalidate_holdings(i)
+            raise ValueError("Asset count couldn't be less than zero")
+
+    def get_counts(self, dates):
+        if self._trade_index is None:
+            self._trade_index = pd.DatetimeIndex(self._trade_dates)
+        pos = self._trade_index.searchsorted(pd.DatetimeIndex(dates), side = 'right') - 1
+        # Dates before the first trade index -1, which points at the appended zero
+        return np.append(self._get_holdings(), 0)[pos]
+
+    def _check_date(self, date_):
+        # Only days of the price series can be looked up, as rows of the
+        # daily frame could
+        date_ = pd.Timestamp(date_)
+        series = self.series
+        if series.first_date is None or not (series.first_date <= date_ <= series.last_updated) \
+                or date_ != date_.normalize():
+            raise KeyError(date_)
+        return date_
 
     def get_price(self, date_):
-        return self.stats.loc[date_]['price']
+        return self.series.get_prices([self._check_date(date_)])[0]
 
     def get_count(self, date_):
-        return self.stats.loc[date_]['count']
+        return self.get_counts([self._check_date(date_)])[0]
 
     def __eq__(self, other):
         return (self.id == other.id)
@@ -215,16 +1178,15 @@ class Asset:
 class AssetPortfolio:
 
     class Position:
-        def __init__(self, asset, date, price, count, fee):
+        def __init__(self, asset, date, price, count, fee, ledger = True):
+            # Positions of a loaded portfolio are put in the ledgers in bulk
             self.asset = asset
             self.date = date
             self.price = price
             self.count = count
             self.fee = fee
-            self.asset.add(self.date, self.count)
-
-        def __del__(self):
-            self.asset.add(self.date, -self.count)
+            if ledger:
+                self.asset.add(self.date, self.count)
 
         def type(self):
             if self.count > 0:
@@ -245,18 +1207,25 @@ class AssetPortfolio:
         self.asset_db = db
         self.asset_list = []
         self.position_list = []
+        self._matrix_key = None
+        self._matrix = None
+
+    def _find_asset(self, id):
+        for asset in self.asset_list:
+            if asset.id == id:
+                return asset
+        return None
 
     def add_asset(self, id):
-        new_asset = Asset(id, self.asset_db, self.creation_date)
-        if new_asset not in self.asset_list:
-            self.asset_list.append(new_asset)
+        if self._find_asset(id) is None:
+            self.asset_list.append(Asset(id, self.asset_db, self.creation_date))
             logging.info('Asset %s added to portfolio.asset_list' % id)
         else:
             logging.info('Asset %s is already in portfolio.asset_list' % id)
 
     def remove_asset(self, id):
-        asset = Asset(id, self.asset_db)
-        if asset in self.asset_list:
+        asset = self._find_asset(id)
+        if asset is not None:
             new_pos_list = []
             for pos in self.position_list:
                 if type(pos) == self.Fee:
@@ -276,12 +1245,10 @@ class AssetPortfolio:
             raise ValueError('Date is earlier than portfolio creation date!')
         if date > self.last_updated:
             raise ValueError('Date is greater than portfolio last update date!')
-        asset = Asset(id, self.asset_db)
-        if asset in self.asset_list:
-            idx = self.asset_list.index(asset)
-            position = self.Position(self.asset_list[idx], pd.to_datetime(date), price, count, fee)
-            self.position_list.append(position)
-            self.position_list.sort(key = lambda x: x.date)
+        asset = self._find_asset(id)
+        if asset is not None:
+            position = self.Position(asset, pd.to_datetime(date), price, count, fee)
+            bisect.insort(self.position_list, position, key = lambda x: x.date)
             logging.info('Position (%s) (%s, %s, %f, %f, %f) added' % (position.type(), id, date, price, count, fee))
         else:
             logging.info('Asset %s is not in portfolio.asset_list' % id)
@@ -296,11 +1263,13 @@ class AssetPortfolio:
         date = pd.to_datetime(date)
         if date < self.creation_date:
             raise ValueError('Date is earlier than portfolio creation date!')
-        self.position_list.append(self.Fee(pd.to_datetime(date), fee))
-        self.position_list.sort(key = lambda x: x.date)
+        bisect.insort(self.position_list, self.Fee(pd.to_datetime(date), fee), key = lambda x: x.date)
         logging.info('Fee (%s, %f) paid' % (date, fee))
 
     def remove_position(self, n):
+        pos = self.position_list[n]
+        if pos.type() != 'fee':
+            pos.asset.remove(pos.date, pos.count)
         self.position_list.pop(n)
         logging.info('Position %d removed' % n)
 
@@ -322,21 +1291,66 @@ class AssetPortfolio:
             asset_list.append(asset.description)
         return pd.DataFrame(asset_list)
 
-    def update(self):
-        today = pd.to_datetime(date.today())
-        if today != self.last_updated:
-            for asset in self.asset_list:
-                asset.update()
+    def _finish_update(self, report, today):
+        ids = [asset.id for asset in self.asset_list]
+        failed = [row[0] for row in report if row[1] == 'error' and row[0] in ids]
+        if len(failed) == 0:
             logging.info('Portfolio updated from %s' % self.last_updated)
             self.last_updated = today
+        else:
+            # Keep the old date so that the next update retries the failed assets
+            logging.warning('Portfolio is not updated, failed assets: %s' % ', '.join(failed))
+
+    @_timed('portfolio.update')
+    def update(self, workers = 1):
+        today = pd.to_datetime(date.today())
+        report = []
+        if today != self.last_updated:
+            with ThreadPoolExecutor(max_workers = workers) as executor:
+                report = list(executor.map(_update_asset, self.asset_list))
+            self._finish_update(report, today)
         else:
             logging.info('Portfolio is up to date')
+        return pd.DataFrame(report, columns = ['id', 'status', 'time', 'error'])
+
+    def _get_matrix(self):
+        # Dates x assets arrays of prices and holdings, rebuilt when any asset changes
+        key = [(id(asset), asset._version, asset.series._version) for asset in self.asset_list]
+        if self._matrix_key != key:
+            # Days priced for every asset; shared series may start before this
+            # portfolio was created
+            series = [asset.series for asset in self.asset_list]
+            if len(series) == 0 or any(s.first_date is None for s in series):
+                dates = pd.DatetimeIndex([])
+            else:
+                start = max([self.creation_date] + [s.first_date for s in series])
+                dates = pd.date_range(start, min(s.last_updated for s in series))
+            prices = np.zeros((len(dates), len(self.asset_list)))
+            counts = np.zeros((len(dates), len(self.asset_list)))
+            for i, asset in enumerate(self.asset_list):
+                prices[:, i] = asset.series.get_prices(dates)
+                counts[:, i] = asset.get_counts(dates)
+            self._matrix = (dates, prices, counts)
+            self._matrix_key = key
+        return self._matrix
+
+    def _get_row(self, date_):
+        dates, prices, counts = self._get_matrix()
+        if len(self.asset_list) == 0:
+            return np.zeros(0), np.zeros(0)
+        i = dates.get_loc(pd.to_datetime(date_))
+        return prices[i], counts[i]
 
     def get_price(self, date_):
-        price = 0
-        for asset in self.asset_list:
-            price += asset.get_count(date_) * asset.get_price(date_)
-        return price
+        prices, counts = self._get_row(date_)
+        return prices.dot(counts)
+
+    def get_value_series(self, start = None, end = None):
+        dates, prices, counts = self._get_matrix()
+        lo = 0 if start is None else dates.searchsorted(pd.to_datetime(start), side = 'left')
+        hi = len(dates) if end is None else dates.searchsorted(pd.to_datetime(end), side = 'right')
+        values = (prices[lo:hi] * counts[lo:hi]).sum(axis = 1)
+        return pd.Series(values, index = dates[lo:hi], name = 'Portfolio')
 
     def get_alltime_stats(self):
         opened = 0
@@ -356,62 +1370,66 @@ class AssetPortfolio:
                             columns = ['Start date', 'End date', 'Invested', 'Closed', 'Fees',
                                        'Current portfolio price', 'Result', 'Result %'])
 
-    def get_stats(self, time_offset):
-
-        def get_state(date_):
-            state = {}
-            for asset in self.asset_list:
-                state[asset.name] = asset.get_price(date_)
-            state['Portfolio'] = self.get_price(date_)
-            return state
-
-        date = pd.to_datetime(self.last_updated)
-        prev_date = date
-
-        state = get_state(date)
+    def _get_trade_flows(self):
+        trades = [pos for pos in self.position_list if pos.type() != 'fee']
+        # Typed even without trades, where an empty frame would be object dtype
+        flows = pd.DataFrame({'date': pd.DatetimeIndex([pos.date for pos in trades]),
+                              'amount': np.array([pos.count * pos.price for pos in trades], dtype = float)})
+        flows['Invested'] = flows['amount'].clip(lower = 0)
+        flows['Closed'] = -flows['amount'].clip(upper = 0)
+        return flows
 
-        states = []
-        dates = []
-        invest = []
-
-        end = False
-        while not end:
-
-            prev_date -= time_offset
+    @_timed('portfolio.get_stats')
+    def get_stats(self, time_offset):
+        # Period boundaries go back from the last update by time_offset until the creation date
+        bounds = [pd.to_datetime(self.last_updated)]
+        while True:
+            prev_date = bounds[-1] - time_offset
             if prev_date <= self.creation_date:
-                prev_date = self.creation_date
-                end = True
-            prev_state = get_state(prev_date)
-
-            opened = 0
-            closed = 0
-            for pos in self.position_list:
-                if pos.date < prev_date: continue
-                if pos.date >= date: break
-                p_type = pos.type()
-                if p_type == 'open':
-                    opened += pos.count * pos.price
-                elif p_type == 'close':
-                    closed += -pos.count * pos.price
-
-            adj_result = ''
-            for key in prev_state.keys():
-                if prev_state[key] != 0:
-                    if key == 'Portfolio':
-                        adj_result = '%+.2f' % ((state[key] + closed - opened - prev_state[key]) / prev_state[key] * 100)
-                    state[key] = str(state[key]) + ' (%+.2f)' % ((state[key] - prev_state[key]) / prev_state[key] * 100)
-
-            invest.append(pd.Series([adj_result, opened, closed], index = ['Adjusted portfolio result', 'Invested', 'Closed']))
-            dates.append(pd.Series([prev_date, date], index = ['Start date',  'End date']))
-            states.append(state)
-
-            date = prev_date
-            state = prev_state
-
-        stats_df = pd.DataFrame.from_dict(states)
-        portfolio_df = stats_df['Portfolio']
-        stats_df = stats_df.drop(['Portfolio'], axis = 1)
-        return pd.concat([pd.DataFrame(dates), stats_df, portfolio_df, pd.DataFrame(invest)], axis = 1)
+                bounds.append(self.creation_date)
+                break
+            bounds.append(prev_date)
+        bounds = pd.DatetimeIndex(bounds)
+
+        dates, prices, counts = self._get_matrix()
+        if len(self.asset_list) == 0:
+            idx = np.zeros(len(bounds), dtype = int)
+            prices = counts = np.zeros((1, 0))
+        else:
+            idx = dates.get_indexer(bounds)
+            if (idx < 0).any():
+                raise KeyError(bounds[idx < 0][0])
+        bound_prices = prices[idx]
+        bound_values = (bound_prices * counts[idx]).sum(axis = 1)
+
+        def change(values):
+            end, start = values[:-1], values[1:]
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                return np.where(start != 0, (end - start) / start * 100, np.nan)
+
+        stats_df = pd.DataFrame({'Start date': bounds[1:], 'End date': bounds[:-1]})
+        for i, asset in enumerate(self.asset_list):
+            stats_df[asset.name] = bound_prices[:-1, i]
+            stats_df[asset.name + ' %'] = change(bound_prices[:, i])
+        stats_df['Portfolio'] = bound_values[:-1]
+        stats_df['Portfolio %'] = change(bound_values)
+
+        # Trades fall into the period [start, end) containing their date
+        flows = self._get_trade_flows()
+        period = len(bounds) - 1 - bounds[::-1].searchsorted(flows['date'], side = 'right')
+        in_range = (period >= 0) & (flows['date'] >= bounds[-1])
+        flows = flows[in_range].groupby(period[in_range])[['Invested', 'Closed']].sum()
+        flows = flows.reindex(range(len(bounds) - 1), fill_value = 0)
+        invested = flows['Invested'].to_numpy()
+        closed = flows['Closed'].to_numpy()
+
+        start_values = bound_values[1:]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            adjusted = (bound_values[:-1] + closed - invested - start_values) / start_values * 100
+        stats_df['Adjusted portfolio result %'] = np.where(start_values != 0, adjusted, np.nan)
+        stats_df['Invested'] = invested
+        stats_df['Closed'] = closed
+        return stats_df
 
     def get_weekly_stats(self):
         return self.get_stats(pd.offsets.Week(weekday = 0))
@@ -422,82 +1440,236 @@ class AssetPortfolio:
     def get_annual_stats(self):
         return self.get_stats(pd.offsets.YearBegin())
 
-    def save(self, name):
-        data = [self.creation_date, self.last_updated, self.asset_db, self.asset_list, self.position_list]
-        with open('%s.pkl' % name, 'wb') as f:
-            pickle.dump(data, f)
-        logging.info('Portfolio saved to %s.pkl' % name)
+    # Directory layout: manifest.json with dates, catalogue entries and file
+    # lengths; prices/<id>.i8 and prices/<id>.f8 with the price change points
+    # of each asset (int64 ns dates and float64 prices) starting at its
+    # 'first_date'; trades.bin with the position ledger.
+    # Price and trade files are only appended to while the saved data is a
+    # prefix of the current one, otherwise they are replaced.
+    format_version = 2
+    trade_dtype = np.dtype([('kind', 'i1'), ('asset', 'i4'), ('date', 'i8'),
+                            ('price', 'f8'), ('count', 'f8'), ('fee', 'f8')])
+
+    def _get_trade_records(self, asset_ids):
+        records = np.zeros(len(self.position_list), dtype = self.trade_dtype)
+        for i, pos in enumerate(self.position_list):
+            if pos.type() == 'fee':
+                records[i] = (1, -1, pos.date.value, np.nan, np.nan, pos.fee)
+            else:
+                records[i] = (0, asset_ids.index(pos.asset.id), pos.date.value, pos.price, pos.count, pos.fee)
+        return records
+
+    def _read_manifest(self, path):
+        manifest_path = path / 'manifest.json'
+        if not manifest_path.exists():
+            return None
+        with open(manifest_path, encoding = 'utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != self.format_version:
+            raise ValueError('Unsupported portfolio format version: %s' % manifest.get('version'))
+        return manifest
+
+    def _write_array(self, path, values, saved_rows):
+        # Append the tail when possible; rewrite through a temporary file so
+        # that memory-mapped readers of the old file are not affected.
+        if saved_rows != None and path.exists() and path.stat().st_size == saved_rows * values.itemsize:
+            with open(path, 'ab') as f:
+                f.write(values[saved_rows:].tobytes())
+        else:
+            tmp_path = path.with_name(path.name + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                f.write(values.tobytes())
+            os.replace(tmp_path, path)
+
+    def save(self, name, format = 'dir'):
+        if format == 'pickle':
+            data = [self.creation_date, self.last_updated, self.asset_db, self.asset_list, self.position_list]
+            with open('%s.pkl' % name, 'wb') as f:
+                pickle.dump(data, f)
+            logging.info('Portfolio saved to %s.pkl' % name)
+            return
+        elif format != 'dir':
+            raise ValueError('Unknown portfolio format: %s' % format)
+
+        path = pathlib.Path(name)
+        (path / 'prices').mkdir(parents = True, exist_ok = True)
+        old_manifest = self._read_manifest(path) or {'version': self.format_version, 'assets': [], 'trades': None}
+        old_assets = {entry['id']: entry for entry in old_manifest['assets']}
+
+        assets = []
+        for asset in self.asset_list:
+            series = asset.series
+            first_date = series.first_date.isoformat() if series.first_date is not None else None
+            old_entry = old_assets.get(asset.id)
+            saved_rows = None
+            if old_entry != None and old_entry['first_date'] == first_date and old_entry['rows'] <= len(series):
+                saved_rows = old_entry['rows']
+            self._write_array(path / 'prices' / ('%s.i8' % asset.id), series._dates, saved_rows)
+            self._write_array(path / 'prices' / ('%s.f8' % asset.id), series._prices, saved_rows)
+            description = {key: (None if pd.isna(value) else value) for key, value in asset.description.items()}
+            assets.append({'id': asset.id,
+                           'description': description,
+                           'last_updated': asset.last_updated.isoformat(),
+                           'first_date': first_date,
+                           'rows': len(series)})
+
+        asset_ids = [asset.id for asset in self.asset_list]
+        trades = self._get_trade_records(asset_ids)
+        saved_trades = old_manifest['trades']
+        if saved_trades != None and [entry['id'] for entry in old_manifest['assets']] == asset_ids \
+                and saved_trades <= len(trades):
+            saved = np.fromfile(path / 'trades.bin', dtype = self.trade_dtype, count = saved_trades)
+            if len(saved) != saved_trades or saved.tobytes() != trades[:saved_trades].tobytes():
+                saved_trades = None
+        else:
+            saved_trades = None
+        self._write_array(path / 'trades.bin', trades, saved_trades)
+
+        manifest = {'version': self.format_version,
+                    'creation_date': self.creation_date.isoformat(),
+                    'last_updated': self.last_updated.isoformat(),
+                    'assets': assets,
+                    'trades': len(trades)}
+        tmp_path = path / 'manifest.json.tmp'
+        with open(tmp_path, 'w', encoding = 'utf-8') as f:
+            json.dump(manifest, f, ensure_ascii = False, indent = 1)
+        os.replace(tmp_path, path / 'manifest.json')
+        for price_path in (path / 'prices').glob('*.[fi]8'):
+            if price_path.stem not in asset_ids:
+                price_path.unlink()
+        logging.info('Portfolio saved to %s' % path)
+
+    def _replay_positions(self):
+        # Rebuilds the ledgers from the positions; ledgers restored from
+        # older pickles only know the net change per day.
+        trades = {id(asset): ([], []) for asset in self.asset_list}
+        for pos in self.position_list:
+            if pos.type() != 'fee':
+                dates, counts = trades[id(pos.asset)]
+                dates.append(pos.date.value)
+                counts.append(pos.count)
+        for asset in self.asset_list:
+            asset._set_ledger(*trades[id(asset)])
 
     def load(self, name):
-        with open('%s.pkl' % name, 'rb') as f:
-            data = pickle.load(f)
-        self.creation_date = data[0]
-        self.last_updated = data[1]
-        self.asset_db = data[2]
-        self.asset_list = data[3]
-        self.position_list = data[4]
-        logging.info('Portfolio loaded from %s.pkl' % name)
+        path = pathlib.Path(name)
+        if not path.is_dir():
+            with open('%s.pkl' % name, 'rb') as f:
+                data = pickle.load(f)
+            self.creation_date = data[0]
+            self.last_updated = data[1]
+            self.asset_db = data[2]
+            self.asset_list = data[3]
+            self.position_list = data[4]
+            self._replay_positions()
+            logging.info('Portfolio loaded from %s.pkl' % name)
+            return self
+
+        manifest = self._read_manifest(path)
+        if manifest == None:
+            raise ValueError('Wrong portfolio directory')
+        self.creation_date = pd.Timestamp(manifest['creation_date'])
+        self.last_updated = pd.Timestamp(manifest['last_updated'])
+        self.asset_list = []
+        for entry in manifest['assets']:
+            description = {key: (float('nan') if value is None else value)
+                           for key, value in entry['description'].items()}
+            description = pd.Series(description, name = entry['id'], dtype = object)
+            asset = Asset(entry['id'], self.asset_db, self.creation_date, description = description)
+            # A series already filled for another portfolio keeps its own prices
+            if asset.series._version == 0:
+                asset.last_updated = pd.Timestamp(entry['last_updated'])
+                if entry['rows'] != 0:
+                    # Change points are memory-mapped; pages are read on first access
+                    series = asset.series
+                    series.first_date = pd.Timestamp(entry['first_date'])
+                    series._dates = np.memmap(path / 'prices' / ('%s.i8' % entry['id']), dtype = np.int64,
+                                              mode = 'r', shape = (entry['rows'],))
+                    series._prices = np.memmap(path / 'prices' / ('%s.f8' % entry['id']), dtype = np.float64,
+                                               mode = 'r', shape = (entry['rows'],))
+                    series._version += 1
+            self.asset_list.append(asset)
+
+        trades = np.fromfile(path / 'trades.bin', dtype = self.trade_dtype, count = manifest['trades'])
+        self.position_list = []
+        for kind, i, date_, price, count, fee in trades.tolist():
+            if kind == 1:
+                self.position_list.append(self.Fee(pd.Timestamp(date_), fee))
+            else:
+                self.position_list.append(self.Position(self.asset_list[i], pd.Timestamp(date_), price, count, fee,
+                                                        ledger = False))
+        for i, asset in enumerate(self.asset_list):
+            own = trades[(trades['kind'] == 0) & (trades['asset'] == i)]
+            asset._set_ledger(own['date'], own['count'])
+        logging.info('Portfolio loaded from %s' % path)
         return self
 
     def get_asset_counts(self, date_ = None):
         if date_ == None:
             date_ = self.last_updated
-        counts = {}
-        price = self.get_price(date_)
-        for asset in self.asset_list:
-            count = asset.get_count(date_)
-            asset_price = asset.get_price(date_)
-            counts[asset.name] = [count]
+        prices, counts = self._get_row(date_)
+        counts = {asset.name: [count] for asset, count in zip(self.asset_list, counts)}
         counts['Date'] = [date_]
         return pd.DataFrame.from_dict(counts)
 
     def get_distribution(self, date_ = None):
         if date_ == None:
             date_ = self.last_updated
-        counts = {}
-        price = self.get_price(date_)
-        for asset in self.asset_list:
-            count = asset.get_count(date_)
-            asset_price = asset.get_price(date_)
-            counts[asset.name] = [count*asset_price/price]
+        prices, counts = self._get_row(date_)
+        values = prices * counts
+        price = values.sum()
+        counts = {asset.name: [value/price] for asset, value in zip(self.asset_list, values)}
         counts['Date'] = [date_]
         return pd.DataFrame.from_dict(counts)
 
-import cvxpy
-
 class Rebalancer:
 
-    def rebalance(self, portfolio, target_distr, refill = 0):
+    # Counts of assets already held in fractions are rounded to this step
+    real_multiplier = 10 ** 6
+
+    def _get_market(self, portfolio):
+        date = portfolio.last_updated
+        asset_prices = np.array([asset.get_price(date) for asset in portfolio.asset_list], dtype = float)
+        counts = np.array([asset.get_count(date) for asset in portfolio.asset_list], dtype = float)
+        multipliers = np.where(counts % 1 != 0, self.real_multiplier, 1)
+        return date, asset_prices, counts, multipliers
+
+    def _solve(self, asset_prices, multipliers, target_values):
+        # The objective ||diag(prices / target) x - distr|| is separable, so
+        # each count is independently the grid point nearest to value / price.
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            x = np.round(target_values / asset_prices * multipliers)
+        return np.where(asset_prices == 0, 0, x) / multipliers
+
+    def _solve_cvxpy(self, asset_prices, multipliers, target_distr, target_price):
+        import cvxpy
+        A = np.diag(asset_prices / multipliers / target_price)
+        y = np.array(target_distr)
+        x = cvxpy.Variable(len(asset_prices), integer = True)
+        obj = cvxpy.Minimize(cvxpy.norm(A @ x - y, 2))
+        prob = cvxpy.Problem(obj)
+        prob.solve()
+        return np.array(x.value).reshape(-1,) / multipliers
+
+    @_timed('rebalancer.rebalance')
+    def rebalance(self, portfolio, target_distr, refill = 0, solver = 'exact'):
         n_assets = len(portfolio.asset_list)
         if len(target_distr) != n_assets:
             raise Exception('Wrong len of target_split')
-        if sum(target_distr) != 1:
+        if not np.allclose(sum(target_distr), 1):
             raise Exception('Wrong partitioning')
 
-        date = portfolio.last_updated
+        date, asset_prices, counts, multipliers = self._get_market(portfolio)
         portfolio_price = portfolio.get_price(date)
         target_price = portfolio_price + refill
-        asset_prices = []
-        assets_with_real_counts = []
-        for i, asset in enumerate(portfolio.asset_list):
-            asset_prices.append(asset.get_price(date))
-            if asset.get_count(date) % 1 != 0:
-                assets_with_real_counts.append(i)
-
-        real_multiplier = 10 ** 6
-        for i in assets_with_real_counts:
-            asset_prices[i] /= real_multiplier
-
-        A = np.diag(asset_prices/target_price)
-        y = np.array(target_distr)
-        x = cvxpy.Int(n_assets)
-        obj = cvxpy.Minimize(cvxpy.norm(A * x - y, 2))
-        prob = cvxpy.Problem(obj)
-        sol = prob.solve()
-        x_val = np.array(x.value).reshape(-1,).tolist()
+        assets_with_real_counts = np.flatnonzero(multipliers != 1).tolist()
 
-        for i in assets_with_real_counts:
-            x_val[i] /= real_multiplier
+        if solver == 'exact':
+            x_val = self._solve(asset_prices, multipliers, np.array(target_distr) * target_price).tolist()
+        elif solver == 'cvxpy':
+            x_val = self._solve_cvxpy(asset_prices, multipliers, target_distr, target_price).tolist()
+        else:
+            raise ValueError('Unknown solver: %s' % solver)
 
         eps = 10 ** -6
         output = []
@@ -526,3 +1698,20 @@ class Rebalancer:
             output.append([asset.name, price, count, price*count, new_count, price*new_count, price*delta_count, tip, distr, new_distr])
 
         return pd.DataFrame(output, columns=output_cols)
+
+    def rebalance_batch(self, portfolio, target_distrs, refills = 0):
+        target_distrs = np.atleast_2d(np.array(target_distrs, dtype = float))
+        if target_distrs.shape[1] != len(portfolio.asset_list):
+            raise Exception('Wrong len of target_split')
+        if not np.allclose(target_distrs.sum(axis = 1), 1):
+            raise Exception('Wrong partitioning')
+
+        date, asset_prices, counts, multipliers = self._get_market(portfolio)
+        refills = np.broadcast_to(np.array(refills, dtype = float), (len(target_distrs),))
+        target_prices = portfolio.get_price(date) + refills
+        new_counts = self._solve(asset_prices, multipliers, target_distrs * target_prices[:, None])
+
+        result = pd.DataFrame(new_counts, columns = [asset.id for asset in portfolio.asset_list])
+        result['Refill'] = refills
+        result['Error'] = np.linalg.norm(new_counts * asset_prices / target_prices[:, None] - target_distrs, axis = 1)
+        return result
@@ -0,0 +1,708 @@
+"""Offline benchmarks for AssetUtils.
+
+A local HTTP server stands in for investfunds.ru: it serves etf and pif
+listing pages, etf /stats pages and pif export_to_excel.php workbooks built
+by the synthetic generators below, so crawls and history downloads run
+without touching the live site. Parsing throughput is measured on the pages
+in benchmarks/fixtures, which the server also replays for a crawl and
+history downloads over HTTP; the ones shipped are synthetic pages in the
+site's layout, pass --fixtures to use a directory of recorded pages instead.
+The tests share the fakes defined here.
+
+Besides the cases run at each of --sizes, the suite compares the current
+code with the implementations it replaced, on fixed sizes:
+
+    parsing of single 10k- and 100k-row listing pages (--scaling-rows)
+    Asset.update against the per-day scan, 20- and 40-year histories
+    get_stats against the per-period loop, 10- and 20-year histories
+    find through the search index against the str.contains scan
+    portfolio save/load as a directory against pickles, 50 assets, 20 years
+    load_database start-up time and memory, csv against feather
+
+    python benchmarks/run_benchmarks.py --sizes small medium --output results.json
+
+Results are written as JSON, one record per case and size, so that runs on
+different commits can be compared. Generating pif workbooks of arbitrary
+length needs xlwt; without it the fixture workbook is served for every
+request.
+"""
+import io
+import os
+import sys
+import json
+import time
+import pickle
+import shutil
+import tempfile
+import argparse
+import platform
+import threading
+import subprocess
+from datetime import date
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import AssetUtils
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# catalogue: funds per asset type; years: price history length;
+# assets: portfolio size; scenarios: rebalancing what-ifs
+SIZES = {'small':  {'catalogue': 200,   'years': 1,  'assets': 5,  'scenarios': 10},
+         'medium': {'catalogue': 2000,  'years': 10, 'assets': 20, 'scenarios': 100},
+         'large':  {'catalogue': 10000, 'years': 30, 'assets': 50, 'scenarios': 1000}}
+
+LISTING_PAGE_SIZE = 50
+STATS_PAGE_SIZE = 100
+TABLE_HEADER = '<tr><th>Name</th><th></th><th></th><th></th><th></th></tr><tr><th colspan="5"></th></tr>'
+
+
+def listing_page(asset_type, page, n_funds, page_size = LISTING_PAGE_SIZE):
+    rows = []
+    for i in range(page * page_size, min((page + 1) * page_size, n_funds)):
+        if asset_type == 'etf':
+            rows.append('<tr><td><a href="/etf/fund%d/">Synthetic ETF %d</a></td><td>EXCH%d</td>'
+                        '<td>TCK%d</td><td>USD</td></tr>' % (i, i, i % 7, i))
+        else:
+            rows.append('<tr><td><a href="/funds/%d">Synthetic PIF %d</a></td><td>UK %d</td></tr>' % (i, i, i % 11))
+    return ('<html><body><div class="menu">%s</div><table id="funds_table">%s%s</table></body></html>'
+            % ('<a href="/">link</a>' * 50, TABLE_HEADER, ''.join(rows)))
+
+
+def quote(day):
+    return 100 + 20 * np.sin(day.toordinal() / 50.0)
+
+
+def quote_dates(start, end):
+    # Business days only, newest first as on the site
+    return pd.bdate_range(start, end)[::-1]
+
+
+def stats_page(start, end, page, page_size = STATS_PAGE_SIZE):
+    dates = quote_dates(start, end)[page * page_size:(page + 1) * page_size]
+    rows = ''.join('<tr><td>%s</td><td>1</td><td>1</td><td>1</td><td>%.2f USD</td></tr>'
+                   % (d.strftime('%d.%m.%Y'), quote(d)) for d in dates)
+    return '<html><body><table id="funds_table">%s%s</table></body></html>' % (TABLE_HEADER, rows)
+
+
+def export_workbook(start, end):
+    try:
+        import xlwt
+    except ImportError:
+        with open(os.path.join(FIXTURES, 'pif_export.xls'), 'rb') as f:
+            return f.read()
+    wb = xlwt.Workbook()
+    ws = wb.add_sheet('export')
+    for row in range(3):
+        ws.write(row, 0, 'header')
+    for row, d in enumerate(quote_dates(start, end)):
+        ws.write(row + 3, 0, d.strftime('%d.%m.%Y'))
+        ws.write(row + 3, 1, round(quote(d), 2))
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+
+    n_funds = 0
+    # Seconds added to every response, standing in for network latency
+    delay = 0
+    # (asset type, page) of listing pages answered with 503
+    failing_pages = set()
+    # Directory of recorded pages served instead of the generated ones
+    replay = None
+
+    def log_message(self, *args):
+        pass
+
+    def replay_page(self, fixture, page):
+        # The recorded page is the first one; later pages are empty, as past
+        # the end of a listing or history
+        if page > 0:
+            return listing_page('etf', 0, 0).encode()
+        with open(os.path.join(self.replay, fixture), 'rb') as f:
+            return f.read()
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        parse_date = lambda value: pd.to_datetime(value, format = '%d.%m.%Y')
+        if url.path.startswith('/etf') and url.path.endswith('/stats'):
+            fixture, listing, page = 'etf_stats.html', None, int(query['p'])
+        elif url.path.startswith('/etf'):
+            fixture, listing, page = 'etf_list.html', 'etf', int(query['p'])
+        elif url.path.endswith('export_to_excel.php'):
+            fixture, listing, page = 'pif_export.xls', None, 0
+        else:
+            fixture, listing, page = 'pif_list.html', 'pif', int(query['npage'])
+        if (listing, page) in self.failing_pages:
+            return self.send_error(503)
+        if self.replay != None:
+            body = self.replay_page(fixture, page)
+        elif listing != None:
+            body = listing_page(listing, page, self.n_funds).encode()
+        elif fixture == 'etf_stats.html':
+            body = stats_page(parse_date(query['dateStart']), parse_date(query['dateEnd']), page).encode()
+        else:
+            start = pd.Timestamp(int(query['start_year']), int(query['start_month']), int(query['start_day']))
+            end = pd.Timestamp(int(query['finish_year']), int(query['finish_month']), int(query['finish_day']))
+            body = export_workbook(start, end)
+        content_type = 'application/vnd.ms-excel' if fixture.endswith('.xls') else 'text/html; charset=utf-8'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(n_funds, delay = 0, replay = None):
+    handler = type('Handler', (SiteHandler,), {'n_funds': n_funds, 'delay': delay, 'failing_pages': set(),
+                                               'replay': replay})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+
+def make_catalogue(n_funds, offset = 0):
+    # The catalogue a crawl of the server's listing pages builds
+    funds = range(offset, offset + n_funds)
+    ids = ['etffund%d' % i for i in funds] + ['pif%d' % i for i in funds]
+    rows = ([['Synthetic ETF %d' % i, 'EXCH%d' % (i % 7), 'TCK%d' % i, 'fund%d' % i, 'etf'] for i in funds] +
+            [['Synthetic PIF %d' % i, np.nan, np.nan, str(i), 'pif'] for i in funds])
+    return pd.DataFrame(rows, index = ids, columns = AssetUtils.AssetDatabase.db_columns)
+
+
+def price_history(start, end):
+    # The quotes of the server's history pages
+    dates = quote_dates(start, end)
+    return pd.DataFrame({'date': dates, 'price': [round(quote(d), 2) for d in dates]})
+
+
+class ReplayDatabase:
+
+    # Catalogue entries and price histories served from memory; without a
+    # fixed history the quotes of the requested days are generated
+    def __init__(self, prices_df = None):
+        self.prices_df = prices_df
+
+    def get_entry(self, id):
+        return pd.Series({'name': id, 'exchange': 'EXCH0', 'ticker': id.upper(), 'href': id, 'type': 'etf'}, name = id)
+
+    def retrieve_asset_historical(self, id, start_date, end_date):
+        if self.prices_df is None:
+            return price_history(start_date, end_date)
+        return self.prices_df
+
+
+def make_database(server, n_funds):
+    db = AssetUtils.AssetDatabase()
+    base = 'http://127.0.0.1:%d' % server.server_address[1]
+    db.domains = {'etf': base + '/etf', 'pif': base + '/funds'}
+    # The stand-in server needs no politeness limit; keep it out of the timings.
+    db.scheduler = AssetUtils.RequestScheduler(rate = 10**6, burst = 10**6)
+    db._db = make_catalogue(n_funds)
+    return db
+
+
+def make_portfolio(db, size):
+    creation_date = pd.Timestamp(date.today()) - pd.DateOffset(years = size['years'])
+    portfolio = AssetUtils.AssetPortfolio(db, creation_date)
+    for i in range(size['assets']):
+        portfolio.add_asset('etffund%d' % i)
+    return portfolio
+
+
+def add_positions(portfolio):
+    dates = pd.date_range(portfolio.creation_date, portfolio.last_updated, periods = 12).normalize()
+    for i, asset in enumerate(portfolio.asset_list):
+        for j, date_ in enumerate(dates[:-1]):
+            portfolio.buy(asset.id, date_, asset.get_price(date_), 10 + i, 1)
+            if j % 3 == 2:
+                portfolio.sell(asset.id, date_, asset.get_price(date_), 5, 1)
+
+
+def measure(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': float(np.median(times)), 'repeat': repeat}
+
+
+def run_size(name, size, repeat):
+    results = []
+
+    def case(case_name, function, repeat = repeat, **params):
+        result = {'case': case_name, 'size': name, 'params': params}
+        result.update(measure(function, repeat))
+        results.append(result)
+        print('%-40s %-8s %10.4f s' % (case_name, name, result['min']))
+
+    def memory(case_name, n_bytes, **params):
+        results.append({'case': case_name, 'size': name, 'params': params, 'bytes': int(n_bytes)})
+        print('%-40s %-8s %10.1f KiB' % (case_name + ' ' + params['layout'], name, n_bytes / 2 ** 10))
+
+    server = start_server(size['catalogue'])
+    try:
+        db = make_database(server, size['catalogue'])
+        crawl_db = make_database(server, size['catalogue'])
+        for workers in [1, 8]:
+            case('retrieve_database', lambda: crawl_db.retrieve_database(workers = workers), repeat = 1,
+                 workers = workers, funds = 2 * size['catalogue'])
+
+        end = pd.Timestamp(date.today())
+        start = end - pd.DateOffset(years = size['years'])
+        case('retrieve_asset_historical', lambda: db.retrieve_asset_historical('etffund0', start, end),
+             repeat = 1, asset_type = 'etf', years = size['years'])
+        case('retrieve_asset_historical', lambda: db.retrieve_asset_historical('pif0', start, end),
+             repeat = 1, asset_type = 'pif', years = size['years'])
+
+        portfolio = make_portfolio(db, size)
+        case('AssetPortfolio.update', lambda: portfolio.update(workers = 8), repeat = 1,
+             assets = size['assets'], years = size['years'])
+
+        # Price storage of the portfolio: change points against one float64
+        # row per calendar day, and the object-dtype rows stored originally
+        memory('price memory', sum(asset.series.nbytes for asset in portfolio.asset_list),
+               layout = 'change points', assets = size['assets'], years = size['years'])
+        for layout, dtype in [('daily float64', np.float64), ('daily object', object)]:
+            memory('price memory', sum(asset.stats.astype(dtype).memory_usage(deep = True).sum()
+                                       for asset in portfolio.asset_list),
+                   layout = layout, assets = size['assets'], years = size['years'])
+
+        # Ten portfolios holding the same assets, with private and shared prices
+        private = [make_portfolio(db, size) for _ in range(10)]
+        case('AssetPortfolio.update', lambda: [p.update(workers = 8) for p in private], repeat = 1,
+             assets = size['assets'], years = size['years'], portfolios = len(private))
+        registry = AssetUtils.AssetRegistry()
+        previous = AssetUtils.set_registry(registry)
+        shared = [make_portfolio(db, size) for _ in range(10)]
+        AssetUtils.set_registry(previous)
+        case('AssetRegistry.update_all', lambda: registry.update_all(shared, workers = 8), repeat = 1,
+             assets = size['assets'], years = size['years'], portfolios = len(shared))
+
+        asset = make_portfolio(db, size).asset_list[0]
+        asset.update()
+        prices_df = db.retrieve_asset_historical(asset.id, asset.stats.index[0], end)
+        asset.series._db = type('Replay', (), {'retrieve_asset_historical': lambda self, *args: prices_df})()
+
+        def update_asset():
+            asset.last_updated = asset.stats.index[0] - pd.Timedelta(days = 1)
+            asset.stats = asset.stats.iloc[:0]
+            asset.update()
+        case('Asset.update', update_asset, years = size['years'], note = 'history replayed from memory')
+
+        add_positions(portfolio)
+        for label, offset in [('weekly', pd.offsets.Week(weekday = 0)),
+                              ('monthly', pd.offsets.MonthBegin()),
+                              ('annual', pd.offsets.YearBegin())]:
+            case('get_stats', lambda: portfolio.get_stats(offset), period = label,
+                 assets = size['assets'], years = size['years'])
+
+        indexed_db = make_database(server, size['catalogue'])
+        indexed_db.build_search_index()
+        for token in ['etf 1', 'synthetic pif 42', 'tck99']:
+            case('find', lambda: db.find(token), token = token, index = False)
+            case('find', lambda: indexed_db.find(token), token = token, index = True)
+
+        rebalancer = AssetUtils.Rebalancer()
+        distr = np.full(size['assets'], 1.0 / size['assets'])
+        distr[-1] = 1 - distr[:-1].sum()
+        case('Rebalancer.rebalance', lambda: rebalancer.rebalance(portfolio, distr.tolist(), refill = 1000),
+             assets = size['assets'])
+        scenarios = np.random.default_rng(0).dirichlet(np.ones(size['assets']), size['scenarios'])
+        case('Rebalancer.rebalance_batch', lambda: rebalancer.rebalance_batch(portfolio, scenarios, 1000),
+             assets = size['assets'], scenarios = size['scenarios'])
+    finally:
+        server.shutdown()
+    return results
+
+
+def run_parsing(fixtures, repeat):
+    results = []
+    db = AssetUtils.AssetDatabase()
+    cases = [('etf_list.html', lambda content: db._parse_listing_page(content, 'etf')),
+             ('pif_list.html', lambda content: db._parse_listing_page(content, 'pif')),
+             ('etf_stats.html', lambda content: db._extract_table(content))]
+    for file_name, parse in cases:
+        path = os.path.join(fixtures, file_name)
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            content = f.read()
+        result = {'case': 'parse', 'size': 'fixture', 'params': {'fixture': file_name, 'bytes': len(content)}}
+        result.update(measure(lambda: parse(content), repeat))
+        result['mb_per_s'] = len(content) / result['min'] / 2 ** 20
+        results.append(result)
+        print('%-40s %-8s %10.4f s' % ('parse ' + file_name, 'fixture', result['min']))
+    return results
+
+
+def run_replay(fixtures, repeat):
+    # A crawl and history downloads against the recorded pages served over
+    # HTTP: one listing page per asset type, one history page and the workbook
+    results = []
+    server = start_server(0, replay = fixtures)
+    try:
+        db = make_database(server, 0)
+        cases = [('retrieve_database', lambda: db.retrieve_database(), {})]
+        db.retrieve_database()
+        end = pd.Timestamp(date.today())
+        for asset_type in ['etf', 'pif']:
+            id = db._db.index[db._db['type'] == asset_type][0]
+            cases.append(('retrieve_asset_historical',
+                          lambda id = id: db.retrieve_asset_historical(id, end - pd.DateOffset(years = 1), end),
+                          {'asset_type': asset_type}))
+        for case_name, function, params in cases:
+            result = {'case': case_name, 'size': 'replay', 'params': params}
+            result.update(measure(function, repeat))
+            results.append(result)
+            print('%-40s %-8s %10.4f s' % (' '.join([case_name] + list(params.values())), 'replay', result['min']))
+    finally:
+        server.shutdown()
+    return results
+
+
+def run_scaling(rows, repeat):
+    # Single listing and history pages of growing length; the time per row
+    # should stay flat if tables are built in one pass.
+    results = []
+    db = AssetUtils.AssetDatabase()
+    db._db = pd.DataFrame([['Synthetic ETF 0', 'EXCH0', 'TCK0', 'fund0', 'etf']], index = ['etffund0'],
+                          columns = db.db_columns)
+    for n_rows in rows:
+        listing = listing_page('etf', 0, n_rows, page_size = n_rows).encode()
+        start = pd.Timestamp('1700-01-01')
+        end = pd.bdate_range(start, periods = n_rows)[-1]
+        pages = [stats_page(start, end, 0, page_size = n_rows).encode(), stats_page(start, start, 1).encode()]
+        db._request = lambda url, params, **kwargs: type('Response', (), {'status_code': 200,
+                                                                          'content': pages[params['p']]})
+        cases = [('parse listing page', lambda: db._parse_listing_page(listing, 'etf')),
+                 ('parse history page', lambda: db._download_asset_historical('etffund0', start, end))]
+        for case_name, function in cases:
+            result = {'case': case_name, 'size': 'scaling', 'params': {'rows': n_rows}}
+            result.update(measure(function, repeat if n_rows <= 10000 else 1))
+            result['us_per_row'] = result['min'] / n_rows * 10 ** 6
+            results.append(result)
+            print('%-40s %-8s %10.4f s %8.1f us/row' % ('%s (%d rows)' % (case_name, n_rows), 'scaling',
+                                                       result['min'], result['us_per_row']))
+    return results
+
+
+def baseline_daily_prices(prices_df, date_range):
+    # Asset.update before the as-of lookup: a scan of the newest-first quotes per day
+    price = []
+    for s in date_range:
+        prices = prices_df[prices_df['date'] <= s]
+        price.append(prices.iloc[0]['price'] if len(prices) != 0 else np.nan)
+    return price
+
+
+def run_asset_update(repeat):
+    results = []
+    end = pd.Timestamp(date.today())
+    for years in [20, 40]:
+        start = end - pd.DateOffset(years = years)
+        prices_df = price_history(start, end)
+        date_range = pd.date_range(start, end)
+
+        def update():
+            asset = AssetUtils.Asset('etffund0', ReplayDatabase(prices_df), start)
+            asset.update()
+            return asset
+        baseline = baseline_daily_prices(prices_df, date_range)
+        if not np.allclose(update().series.get_prices(date_range), baseline, equal_nan = True):
+            raise AssertionError('Asset.update prices differ from the per-day scan')
+        for implementation, function in [('per-day scan', lambda: baseline_daily_prices(prices_df, date_range)),
+                                          ('as-of lookup', update)]:
+            result = {'case': 'Asset.update', 'size': 'history',
+                      'params': {'years': years, 'quotes': len(prices_df), 'implementation': implementation}}
+            result.update(measure(function, repeat if implementation == 'as-of lookup' else 1))
+            results.append(result)
+            print('%-40s %-8s %10.4f s' % ('Asset.update %s (%d years)' % (implementation, years), 'history',
+                                           result['min']))
+    return results
+
+
+def baseline_get_stats(portfolio, time_offset):
+    # AssetPortfolio.get_stats before the single-pass engine: every period
+    # re-values each asset and rescans the position list
+    def get_price(date_):
+        return sum(asset.get_count(date_) * asset.get_price(date_) for asset in portfolio.asset_list)
+
+    def get_state(date_):
+        state = {}
+        for asset in portfolio.asset_list:
+            state[asset.name] = asset.get_price(date_)
+        state['Portfolio'] = get_price(date_)
+        return state
+
+    date_ = pd.to_datetime(portfolio.last_updated)
+    prev_date = date_
+    state = get_state(date_)
+    states, dates, invest = [], [], []
+    end = False
+    while not end:
+        prev_date -= time_offset
+        if prev_date <= portfolio.creation_date:
+            prev_date = portfolio.creation_date
+            end = True
+        prev_state = get_state(prev_date)
+        opened = 0
+        closed = 0
+        for pos in portfolio.position_list:
+            if pos.date < prev_date: continue
+            if pos.date >= date_: break
+            p_type = pos.type()
+            if p_type == 'open':
+                opened += pos.count * pos.price
+            elif p_type == 'close':
+                closed += -pos.count * pos.price
+        adj_result = ''
+        for key in prev_state.keys():
+            if prev_state[key] != 0:
+                if key == 'Portfolio':
+                    adj_result = '%+.2f' % ((state[key] + closed - opened - prev_state[key]) / prev_state[key] * 100)
+                state[key] = str(state[key]) + ' (%+.2f)' % ((state[key] - prev_state[key]) / prev_state[key] * 100)
+        invest.append(pd.Series([adj_result, opened, closed], index = ['Adjusted portfolio result', 'Invested', 'Closed']))
+        dates.append(pd.Series([prev_date, date_], index = ['Start date', 'End date']))
+        states.append(state)
+        date_ = prev_date
+        state = prev_state
+    stats_df = pd.DataFrame.from_dict(states)
+    portfolio_df = stats_df['Portfolio']
+    stats_df = stats_df.drop(['Portfolio'], axis = 1)
+    return pd.concat([pd.DataFrame(dates), stats_df, portfolio_df, pd.DataFrame(invest)], axis = 1)
+
+
+def run_period_stats(repeat):
+    results = []
+    end = pd.Timestamp(date.today())
+    for years in [10, 20]:
+        start = end - pd.DateOffset(years = years)
+        prices_df = price_history(start, end)
+        portfolio = AssetUtils.AssetPortfolio(ReplayDatabase(prices_df), start)
+        for i in range(10):
+            portfolio.add_asset('etffund%d' % i)
+        portfolio.update()
+        add_positions(portfolio)
+        for label, offset in [('weekly', pd.offsets.Week(weekday = 0)),
+                              ('monthly', pd.offsets.MonthBegin()),
+                              ('annual', pd.offsets.YearBegin())]:
+            old = baseline_get_stats(portfolio, offset)
+            new = portfolio.get_stats(offset)
+            if not (np.allclose(old['Invested'].astype(float), new['Invested']) and
+                    np.allclose(old['Closed'].astype(float), new['Closed'])):
+                raise AssertionError('get_stats differs from the per-period loop')
+            for implementation, function in [('per-period loop', lambda: baseline_get_stats(portfolio, offset)),
+                                              ('single pass', lambda: portfolio.get_stats(offset))]:
+                result = {'case': 'get_stats', 'size': 'history',
+                          'params': {'years': years, 'assets': 10, 'period': label,
+                                     'implementation': implementation}}
+                result.update(measure(function, repeat if implementation == 'single pass' else 1))
+                results.append(result)
+                print('%-40s %-8s %10.4f s' % ('get_stats %s %s (%d years)' % (label, implementation, years),
+                                               'history', result['min']))
+    return results
+
+
+def run_search(repeat):
+    # Autocomplete-style queries on a 20k-row catalogue: the index lookup
+    # alone, find() with the index (which also slices the DataFrame) and the
+    # str.contains scan. The first query of a gram builds its posting array.
+    results = []
+    db = AssetUtils.AssetDatabase()
+    db._db = make_catalogue(10000)
+    build = measure(db.build_search_index, 1)
+    results.append({'case': 'build_search_index', 'size': 'search', 'params': {'rows': len(db._db)}, **build})
+    print('%-40s %-8s %10.4f s' % ('build_search_index (%d rows)' % len(db._db), 'search', build['min']))
+    index = db._index
+    scan_db = AssetUtils.AssetDatabase()
+    scan_db._db = db._db
+    for token in ['ex', 'etf 1', 'tck99', 'synthetic pif 42']:
+        first = measure(lambda: index.search(token), 1)['min']
+        cases = [('index lookup', lambda: index.search(token), 1000),
+                 ('find indexed', lambda: db.find(token), 100),
+                 ('find scan', lambda: scan_db.find(token), repeat)]
+        for implementation, function, n in cases:
+            result = {'case': 'find', 'size': 'search',
+                      'params': {'token': token, 'rows': len(db._db), 'implementation': implementation,
+                                 'matches': len(index.search(token))}}
+            result.update(measure(function, n))
+            if implementation == 'index lookup':
+                result['first'] = first
+            results.append(result)
+            print('%-40s %-8s %10.1f us' % ('find %r %s' % (token, implementation), 'search', result['median'] * 10 ** 6))
+    return results
+
+
+def directory_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def run_persistence(repeat):
+    # A 50-asset, 20-year portfolio saved as a directory and as pickles:
+    # the current pickle and one of daily price/count frames like the
+    # original whole-object format.
+    results = []
+    end = pd.Timestamp(date.today())
+    start = end - pd.DateOffset(years = 20)
+    db = ReplayDatabase(price_history(start, end))
+    portfolio = AssetUtils.AssetPortfolio(db, start)
+    for i in range(50):
+        portfolio.add_asset('etffund%d' % i)
+    portfolio.update()
+    add_positions(portfolio)
+
+    def save_daily_pickle(name):
+        frames = []
+        for asset in portfolio.asset_list:
+            stats = asset.stats
+            stats['count'] = asset.get_counts(stats.index)
+            frames.append(stats.astype(object))
+        with open(name, 'wb') as f:
+            pickle.dump([portfolio.creation_date, portfolio.last_updated, frames, portfolio.position_list], f)
+
+    def load_daily_pickle(name):
+        with open(name, 'rb') as f:
+            return pickle.load(f)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'portfolio')
+        load = lambda name: AssetUtils.AssetPortfolio(db, start).load(name)
+        cases = [('directory', 'save', lambda: (shutil.rmtree(path, ignore_errors = True), portfolio.save(path)), path),
+                 ('directory', 'save unchanged', lambda: portfolio.save(path), path),
+                 ('directory', 'load', lambda: load(path), path),
+                 ('directory', 'load and value', lambda: load(path).get_value_series(), path),
+                 ('pickle', 'save', lambda: portfolio.save(path, format = 'pickle'), path + '.pkl'),
+                 ('pickle', 'load', lambda: load(path), path + '.pkl'),
+                 ('daily frames pickle', 'save', lambda: save_daily_pickle(path + '.daily.pkl'), path + '.daily.pkl'),
+                 ('daily frames pickle', 'load', lambda: load_daily_pickle(path + '.daily.pkl'), path + '.daily.pkl')]
+        for layout, operation, function, file_name in cases:
+            if layout == 'pickle' and operation == 'load':
+                # load() prefers the directory when both exist
+                shutil.rmtree(path)
+            result = {'case': 'portfolio %s' % operation, 'size': 'persistence',
+                      'params': {'layout': layout, 'assets': 50, 'years': 20}}
+            result.update(measure(function, repeat))
+            result['bytes'] = directory_size(file_name)
+            results.append(result)
+            print('%-40s %-8s %10.4f s %8.1f MiB' % ('%s %s' % (layout, operation), 'persist',
+                                                     result['min'], result['bytes'] / 2 ** 20))
+    finally:
+        shutil.rmtree(tmp)
+    return results
+
+
+LOAD_DATABASE_SCRIPT = """
+import sys, time, json, resource
+start = time.perf_counter()
+import AssetUtils
+db = AssetUtils.AssetDatabase(search_index = True)
+db.load_database(sys.argv[1])
+elapsed = time.perf_counter() - start
+rss = None
+try:
+    with open('/proc/self/status') as f:
+        rss = [int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:')][0]
+except (OSError, IndexError):
+    pass
+# ru_maxrss is in KiB on Linux and in bytes on macOS
+maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+print(json.dumps({'seconds': elapsed, 'rss': rss, 'maxrss': maxrss, 'rows': len(db._db)}))
+"""
+
+
+def run_load_database(repeat):
+    # Start-up cost of a fresh process that imports AssetUtils and loads a
+    # 20k-row catalogue from the csv and the feather snapshot: time from the
+    # import to a loaded database, resident and peak memory afterwards. The
+    # search index is enabled; it is built on the first find, not here.
+    results = []
+    db = AssetUtils.AssetDatabase()
+    db._db = make_catalogue(10000)
+    tmp = tempfile.mkdtemp()
+    try:
+        for format in ['csv', 'feather']:
+            name = os.path.join(tmp, format, 'catalogue')
+            os.makedirs(os.path.dirname(name))
+            db.save_database(name, format = format)
+            command = [sys.executable, '-c', LOAD_DATABASE_SCRIPT, name]
+            runs = [json.loads(subprocess.run(command, cwd = ROOT, check = True, capture_output = True,
+                                              text = True).stdout) for _ in range(repeat)]
+            times = [run['seconds'] for run in runs]
+            result = {'case': 'load_database', 'size': 'startup',
+                      'params': {'format': format, 'rows': runs[0]['rows']},
+                      'min': min(times), 'median': float(np.median(times)), 'repeat': repeat,
+                      'rss': runs[-1]['rss'], 'maxrss': max(run['maxrss'] for run in runs),
+                      'bytes': os.path.getsize('%s.%s' % (name, format))}
+            results.append(result)
+            rss = result['rss'] if result['rss'] != None else result['maxrss']
+            print('%-40s %-8s %10.4f s %8.1f MiB' % ('load_database %s' % format, 'startup',
+                                                     result['min'], rss / 2 ** 20))
+    finally:
+        shutil.rmtree(tmp)
+    return results
+
+
+def run_import_time(repeat):
+    # Wall time of a fresh interpreter importing the module; guards the lazy imports
+    command = [sys.executable, '-c', 'import AssetUtils']
+    result = {'case': 'import AssetUtils', 'size': 'module', 'params': {}}
+    result.update(measure(lambda: subprocess.run(command, cwd = ROOT, check = True), repeat))
+    # pandas may pull in pyarrow on its own; only modules AssetUtils adds count
+    modules = lambda code: set(subprocess.run([sys.executable, '-c', 'import sys; %s; print(" ".join(sys.modules))' % code],
+                                              cwd = ROOT, check = True, capture_output = True, text = True).stdout.split())
+    loaded = modules('import AssetUtils') - modules('import pandas, numpy')
+    result['heavy_modules_loaded'] = sorted(loaded & {'requests', 'bs4', 'xlrd', 'cvxpy', 'pyarrow'})
+    print('%-40s %-8s %10.4f s' % ('import AssetUtils', 'module', result['min']))
+    return [result]
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+    parser.add_argument('--sizes', nargs = '+', default = ['small'], choices = sorted(SIZES))
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--fixtures', default = FIXTURES)
+    parser.add_argument('--output', default = 'benchmark_results.json')
+    parser.add_argument('--scaling-rows', nargs = '*', type = int, default = [10000, 100000])
+    args = parser.parse_args()
+
+    results = run_import_time(args.repeat) + run_parsing(args.fixtures, args.repeat) + run_replay(args.fixtures, args.repeat)
+    results += run_scaling(args.scaling_rows, args.repeat)
+    results += run_asset_update(args.repeat) + run_period_stats(args.repeat) + run_search(args.repeat)
+    results += run_persistence(args.repeat) + run_load_database(args.repeat)
+    for name in args.sizes:
+        results += run_size(name, SIZES[name], args.repeat)
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = ROOT, check = True,
+                                capture_output = True, text = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    report = {'commit': commit,
+              'timestamp': pd.Timestamp.now().isoformat(),
+              'python': platform.python_version(),
+              'pandas': pd.__version__,
+              'numpy': np.__version__,
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent = 1)
+    print('Results saved to %s' % args.output)
+    if results[0]['heavy_modules_loaded']:
+        sys.exit('Importing AssetUtils loads %s eagerly' % ', '.join(results[0]['heavy_modules_loaded']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import AssetUtils
+import run_benchmarks
+from run_benchmarks import ReplayDatabase
+
+
+class AssetTest(unittest.TestCase):
+
+    def test_days_before_first_quote_are_nan(self):
+        # 2024-06-02 is a Sunday; the first quote is on Monday
+        asset = AssetUtils.Asset('a', ReplayDatabase(), '2024-06-02')
+        self.assertTrue(asset.update())
+        self.assertTrue(np.isnan(asset.get_price('2024-06-02')))
+        self.assertEqual(asset.get_price('2024-06-04'), round(run_benchmarks.quote(pd.Timestamp('2024-06-04')), 2))
+
+
+class LedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.asset = AssetUtils.Asset('a', ReplayDatabase(), '2024-06-03')
+        self.asset.update()
+
+    def test_counts(self):
+        asset = self.asset
+        asset.add('2024-06-10', 10)
+        asset.add('2024-06-04', 5)
+        asset.add('2024-06-10', -3)
+        asset.add('2024-06-20', -12)
+        dates = pd.to_datetime(['2024-06-03', '2024-06-04', '2024-06-09', '2024-06-10', '2024-06-19', '2024-06-20'])
+        self.assertEqual(asset.get_counts(dates).tolist(), [0, 5, 5, 12, 12, 0])
+        asset.remove('2024-06-20', -12)
+        self.assertEqual(asset.get_counts(dates).tolist(), [0, 5, 5, 12, 12, 12])
+        self.assertRaises(LookupError, asset.remove, '2024-06-10', 7)
+
+    def test_negative_holdings_are_rejected(self):
+        asset = self.asset
+        asset.add('2024-06-04', 10)
+        asset.add('2024-06-12', -10)
+        # A sale in between would leave -4 from 2024-06-12 on
+        self.assertRaises(ValueError, asset.add, '2024-06-06', -4)
+        # Removing the purchase would leave -10
+        self.assertRaises(ValueError, asset.remove, '2024-06-04', 10)
+        self.assertEqual(asset._trade_counts, [10, -10])
+        asset.add('2024-06-05', 4)
+        asset.add('2024-06-14', -4)
+        self.assertEqual(asset.get_counts(pd.to_datetime(['2024-06-05', '2024-06-12', '2024-06-14'])).tolist(),
+                         [14, 4, 0])
+
+    def test_appends_do_not_build_the_index(self):
+        asset = self.asset
+        for day in pd.date_range('2024-06-03', periods = 200):
+            asset.add(day, 1)
+        self.assertIsNone(asset._trade_index)
+        self.assertEqual(asset.get_count('2024-06-20'), 18)
+
+    def test_count_and_price_lookups_agree(self):
+        # Both raise KeyError off the days of the price series
+        asset = self.asset
+        asset.add('2024-06-04', 10)
+        for date_ in ['2024-06-02', pd.Timestamp.today().normalize() + pd.Timedelta(days = 1), '2024-06-05 12:00']:
+            self.assertRaises(KeyError, asset.get_price, date_)
+            self.assertRaises(KeyError, asset.get_count, date_)
+        self.assertEqual(asset.get_count('2024-06-05'), 10)
+        fresh = AssetUtils.Asset('b', ReplayDatabase(), '2024-06-03')
+        self.assertRaises(KeyError, fresh.get_count, '2024-06-05')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,218 @@
+import os
+import sys
+import time
+import hashlib
+import unittest
+
+import requests
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import AssetUtils
+import run_benchmarks
+
+
+class CrawlerTest(unittest.TestCase):
+
+    n_funds = 500
+
+    def setUp(self):
+        # Listing pages of the stand-in server answer after 200 ms, so that
+        # latency rather than parsing dominates the sequential crawl
+        self.server = run_benchmarks.start_server(self.n_funds, delay = 0.2)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def crawl(self, workers):
+        db = run_benchmarks.make_database(self.server, self.n_funds)
+        start = time.perf_counter()
+        db.retrieve_database(workers = workers)
+        return db._db, time.perf_counter() - start
+
+    def test_concurrent_crawl_matches_sequential(self):
+        sequential, sequential_time = self.crawl(1)
+        concurrent, concurrent_time = self.crawl(8)
+        self.assertEqual(len(sequential), 2 * self.n_funds)
+        self.assertTrue(sequential.equals(concurrent))
+        self.assertGreater(sequential_time / concurrent_time, 2)
+
+
+class FailedCrawlTest(unittest.TestCase):
+
+    n_funds = 120
+
+    def setUp(self):
+        self.server = run_benchmarks.start_server(self.n_funds)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_failed_sync_keeps_database(self):
+        db = run_benchmarks.make_database(self.server, self.n_funds)
+        db.retrieve_database()
+        old_db = db._db.copy()
+        old_state = dict(db._page_state)
+        db.scheduler.retries = 2
+        db.scheduler.backoff = 0.01
+        self.server.RequestHandlerClass.failing_pages.add(('etf', 1))
+        for workers in [1, 4]:
+            with self.assertRaises(requests.HTTPError):
+                db.sync_database(workers = workers)
+            self.assertTrue(db._db.equals(old_db))
+            self.assertEqual(db._page_state, old_state)
+        self.server.RequestHandlerClass.failing_pages.clear()
+        self.assertEqual(db.sync_database(), {'added': [], 'removed': [], 'changed': []})
+
+    def test_failed_retrieve_keeps_database(self):
+        db = run_benchmarks.make_database(self.server, self.n_funds)
+        db.scheduler.retries = 1
+        db.scheduler.backoff = 0.01
+        self.server.RequestHandlerClass.failing_pages.add(('pif', 0))
+        with self.assertRaises(requests.HTTPError):
+            db.retrieve_database(workers = 2)
+        self.assertEqual(len(db._db), 2 * self.n_funds)
+        self.assertEqual(db._page_state, {})
+
+
+class Response:
+
+    def __init__(self, content, status_code = 200, headers = None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class ListingDatabase(AssetUtils.AssetDatabase):
+
+    # Listing pages served from memory: `pages` maps each asset type to a
+    # list of pages of (href, name) rows. With `etags` every page has an
+    # ETag and a matching If-None-Match is answered with 304.
+    def __init__(self, pages, etags = True):
+        AssetUtils.AssetDatabase.__init__(self)
+        self.pages = pages
+        self.etags = etags
+        self.parsed = []
+        self.not_modified = 0
+
+    def _page_content(self, asset_type, page):
+        funds = self.pages[asset_type][page] if page < len(self.pages[asset_type]) else []
+        if asset_type == 'etf':
+            rows = ['<tr><td><a href="/etf/%s/">%s</a></td><td>EXCH</td><td>T%s</td><td>USD</td></tr>'
+                    % (href, name, href) for href, name in funds]
+        else:
+            rows = ['<tr><td><a href="/funds/%s">%s</a></td><td>UK</td></tr>' % (href, name) for href, name in funds]
+        return ('<table id="funds_table">%s%s</table>' % (run_benchmarks.TABLE_HEADER, ''.join(rows))).encode()
+
+    def _request(self, url, headers = {}, **kwargs):
+        asset_type = 'etf' if url.startswith(self.domains['etf']) else 'pif'
+        content = self._page_content(asset_type, int(url.rsplit('=', 1)[1]))
+        if not self.etags:
+            return Response(content)
+        etag = hashlib.md5(content).hexdigest()
+        if headers.get('If-None-Match') == etag:
+            self.not_modified += 1
+            return Response(b'', 304)
+        return Response(content, headers = {'ETag': etag})
+
+    def _parse_listing_page(self, content, asset_type):
+        rows = AssetUtils.AssetDatabase._parse_listing_page(self, content, asset_type)
+        if rows != None:
+            self.parsed.append(rows[0][0])
+        return rows
+
+
+def funds(start, stop, prefix = 'Fund'):
+    return [('fund%d' % i, '%s %d' % (prefix, i)) for i in range(start, stop)]
+
+
+class SyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pages = {'etf': [funds(0, 5), funds(5, 10)], 'pif': [funds(0, 5)]}
+
+    def check_matches_retrieve(self, db):
+        fresh = ListingDatabase(db.pages)
+        fresh.retrieve_database()
+        self.assertTrue(db._db.equals(fresh._db))
+
+    def test_changes(self):
+        for etags in [True, False]:
+            for workers in [1, 3]:
+                db = ListingDatabase(self.pages, etags = etags)
+                db.retrieve_database()
+                db.parsed = []
+                db.pages = {'etf': [funds(0, 5), funds(5, 10)], 'pif': [funds(0, 5)]}
+                db.pages['etf'][0][1] = ('fund1', 'Renamed fund')
+                db.pages['etf'][1].remove(('fund7', 'Fund 7'))
+                db.pages['etf'][1].append(('fund10', 'Fund 10'))
+                report = db.sync_database(workers = workers)
+                self.assertEqual(report, {'added': ['etffund10'], 'removed': ['etffund7'], 'changed': ['etffund1']})
+                self.check_matches_retrieve(db)
+                # The pif page and the empty pages ending each listing are reused
+                self.assertEqual(sorted(db.parsed), ['etffund0', 'etffund5'])
+                self.assertEqual(db.not_modified, 3 if etags else 0)
+
+    def test_unchanged(self):
+        db = ListingDatabase(self.pages)
+        db.retrieve_database()
+        db.parsed = []
+        self.assertEqual(db.sync_database(), {'added': [], 'removed': [], 'changed': []})
+        self.assertEqual(db.parsed, [])
+        self.check_matches_retrieve(db)
+
+    def test_reused_page_missing_from_catalogue(self):
+        # Rows of an unchanged page are taken from the catalogue, so a page
+        # with rows no longer there is fetched and parsed again
+        db = ListingDatabase(self.pages)
+        db.retrieve_database()
+        db.parsed = []
+        db._db = db._db.drop('etffund6')
+        self.assertEqual(db.sync_database(), {'added': ['etffund6'], 'removed': [], 'changed': []})
+        self.assertEqual(db.parsed, ['etffund5'])
+        self.check_matches_retrieve(db)
+
+    def test_repeated_rows(self):
+        # A fund listed after page 0 was fetched shifts fund4 onto page 1
+        db = ListingDatabase(self.pages)
+        db.retrieve_database()
+        db.pages = {'etf': [funds(0, 5), funds(4, 9), funds(9, 10)], 'pif': [funds(0, 5)]}
+        db.pages['etf'][1][0] = ('fund4', 'Fund 4 renamed')
+        report = db.sync_database()
+        self.assertEqual(report, {'added': [], 'removed': [], 'changed': []})
+        self.assertTrue(db._db.index.is_unique)
+        self.assertEqual(db._db.loc['etffund4', 'name'], 'Fund 4')
+        self.assertEqual(len(db._db), 15)
+
+
+class ReplayTest(unittest.TestCase):
+
+    # The shipped fixtures were recorded from the synthetic server: 50 funds
+    # of each type, etf quotes from 2017-02-13 to 2017-06-30 and pif quotes
+    # of 2017
+
+    def setUp(self):
+        self.server = run_benchmarks.start_server(0, replay = run_benchmarks.FIXTURES)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_recorded_pages(self):
+        db = run_benchmarks.make_database(self.server, 0)
+        db.retrieve_database(workers = 2)
+        self.assertTrue(db._db.sort_index().equals(run_benchmarks.make_catalogue(50).sort_index()))
+        start, end = pd.Timestamp('2017-01-01'), pd.Timestamp('2017-12-31')
+        for id, first in [('etffund0', '2017-02-13'), ('pif0', '2017-01-02')]:
+            prices_df = db.retrieve_asset_historical(id, start, end)
+            expected = run_benchmarks.price_history(first, prices_df['date'].iloc[0])
+            self.assertEqual(prices_df['date'].tolist(), expected['date'].tolist())
+            self.assertEqual(prices_df['price'].tolist(), expected['price'].tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
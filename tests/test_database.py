@@ -0,0 +1,180 @@
+import os
+import sys
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import AssetUtils
+from run_benchmarks import make_catalogue
+
+
+class SearchIndexTest(unittest.TestCase):
+
+    tokens = ['', 'e', 'EX', 'etic', 'etf 1', 'fund1', 'tck12', 'pif 3', 'etf', 'nan', 'c p', 'renamed bond',
+              'missing']
+
+    def check_matches_scan(self, db):
+        scan_db = AssetUtils.AssetDatabase()
+        scan_db._db = db._db
+        for token in self.tokens:
+            self.assertTrue(db.find(token).equals(scan_db.find(token)), token)
+
+    def test_find_matches_scan(self):
+        db = AssetUtils.AssetDatabase()
+        db._db = make_catalogue(300)
+        db.build_search_index()
+        self.check_matches_scan(db)
+
+    def test_incremental_updates(self):
+        # Rows removed, added and changed, in a new row order, as after a sync
+        db = AssetUtils.AssetDatabase()
+        db._db = make_catalogue(300)
+        db.build_search_index()
+        new_db = pd.concat([make_catalogue(50, offset = 1000), make_catalogue(200, offset = 50)])
+        new_db.loc['etffund60', 'name'] = 'Renamed Bond'
+        index = db._index
+        for id in db._db.index.difference(new_db.index):
+            index.remove(id)
+        for id in new_db.index.difference(db._db.index).tolist() + ['etffund60']:
+            index.add(id, new_db.loc[id])
+        index.set_order(new_db.index)
+        db._db = new_db
+        self.check_matches_scan(db)
+
+    def test_built_on_first_find(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            db = AssetUtils.AssetDatabase()
+            db._db = make_catalogue(30)
+            db.save_database(os.path.join(tmp, 'catalogue'))
+            db = AssetUtils.AssetDatabase(search_index = True)
+            db.load_database(os.path.join(tmp, 'catalogue'))
+            self.assertIsNone(db._index)
+            self.check_matches_scan(db)
+            self.assertIsNotNone(db._index)
+            # A new catalogue drops the index built for the old one
+            db._db = make_catalogue(10, offset = 100)
+            db._update_search_index()
+            self.check_matches_scan(db)
+        finally:
+            shutil.rmtree(tmp)
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.name = os.path.join(self.tmp, 'catalogue')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def load(self, name = None):
+        db = AssetUtils.AssetDatabase()
+        db.load_database(name or self.name)
+        return db._db
+
+    def test_round_trip(self):
+        db = AssetUtils.AssetDatabase()
+        db._db = make_catalogue(20)
+        for format in ['csv', 'feather']:
+            db.save_database(self.name + format, format = format)
+            loaded = self.load(self.name + format)
+            self.assertEqual(loaded.index.tolist(), db._db.index.tolist())
+            self.assertEqual(loaded.astype(str).values.tolist(), db._db.astype(str).values.tolist())
+        self.assertEqual(str(loaded['type'].dtype), 'category')
+
+    def test_both_formats_are_kept(self):
+        db = AssetUtils.AssetDatabase()
+        db._db = make_catalogue(1)
+        db.save_database(self.name, format = 'feather')
+        db._db = make_catalogue(2)
+        db.save_database(self.name)
+        self.assertTrue(os.path.exists(self.name + '.feather'))
+        # Neither file is taken for the newer one; the format has to be given
+        with self.assertRaises(ValueError):
+            self.load()
+        loaded = AssetUtils.AssetDatabase()
+        loaded.load_database(self.name, format = 'feather')
+        self.assertEqual(len(loaded._db), 2)
+        loaded.load_database(self.name, format = 'csv')
+        self.assertEqual(len(loaded._db), 4)
+        loaded.load_database(self.name + '.feather')
+        self.assertEqual(len(loaded._db), 2)
+
+    def test_format_from_content(self):
+        db = AssetUtils.AssetDatabase()
+        db._db = make_catalogue(3)
+        db.save_database(self.name, format = 'feather')
+        os.rename(self.name + '.feather', self.name + '.snapshot')
+        loaded = AssetUtils.AssetDatabase()
+        loaded.load_database(self.name + '.snapshot')
+        self.assertEqual(str(loaded._db['type'].dtype), 'category')
+        self.assertEqual(loaded._db.index.tolist(), db._db.index.tolist())
+        self.assertRaises(FileNotFoundError, loaded.load_database, self.name)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_database_has_scheduler(self):
+        db = AssetUtils.AssetDatabase()
+        self.assertIsInstance(db.scheduler, AssetUtils.RequestScheduler)
+        # Pickled before the scheduler was added
+        del db.scheduler
+        db = pickle.loads(pickle.dumps(db))
+        self.assertIsInstance(db.scheduler, AssetUtils.RequestScheduler)
+
+
+class Response:
+
+    def __init__(self, content, status_code = 200):
+        self.content = content
+        self.status_code = status_code
+
+
+class HistoryDatabase(AssetUtils.AssetDatabase):
+
+    # Serves one page of quotes for an etf, then a page without the table
+    def __init__(self):
+        AssetUtils.AssetDatabase.__init__(self)
+        self._db = make_catalogue(1)
+        self.pages = []
+
+    def _request(self, url, **kwargs):
+        page = kwargs['params']['p']
+        self.pages.append(page)
+        if page > 0:
+            return Response(b'<html><body>Service unavailable</body></html>')
+        rows = ''.join('<tr><td>%02d.06.2024</td><td></td><td></td><td></td><td>%d.5 RUB</td></tr>' % (day, day)
+                       for day in range(10, 0, -1))
+        return Response(('<table id="funds_table"><tr><th>Date</th></tr>%s</table>' % rows).encode())
+
+
+class HistoryTest(unittest.TestCase):
+
+    def test_error_page_is_not_end_of_history(self):
+        db = HistoryDatabase()
+        with self.assertRaises(IOError):
+            db.retrieve_asset_historical('etffund0', pd.Timestamp('2024-06-01'), pd.Timestamp('2024-06-10'))
+        self.assertEqual(db.pages, [0, 1])
+
+    def test_partial_history_is_not_cached(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            db = HistoryDatabase()
+            db.price_cache = AssetUtils.PriceCache(os.path.join(tmp, 'prices.sqlite'))
+            with self.assertRaises(IOError):
+                db.retrieve_asset_historical('etffund0', pd.Timestamp('2024-06-01'), pd.Timestamp('2024-06-10'))
+            self.assertEqual(db.price_cache.covered('etffund0'), [])
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
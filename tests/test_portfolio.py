@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import AssetUtils
+from test_registry import CountingDatabase
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class PortfolioPickleTest(unittest.TestCase):
+
+    # baseline_portfolio.pkl was saved by the original pickle-only code: two
+    # etfs from 2024-01-01 to 2024-03-29, two trades of etfa on 2024-02-01
+    # and a fee.
+
+    def setUp(self):
+        self.portfolio = AssetUtils.AssetPortfolio(None, '2000-01-01')
+        self.portfolio.load(os.path.join(FIXTURES, 'baseline_portfolio'))
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def check_values(self, portfolio):
+        counts = portfolio.get_asset_counts('2024-03-29')
+        self.assertEqual(counts[['ETF A', 'ETF B']].values.tolist(), [[13, 7]])
+        self.assertAlmostEqual(portfolio.get_price('2024-03-29'), 2185.0)
+        self.assertEqual(portfolio.asset_list[0].get_count('2024-02-01'), 17)
+        stats = portfolio.get_monthly_stats()
+        self.assertTrue(np.allclose(stats['Invested'], [0, 722.4, 1719.5]))
+        self.assertTrue(np.allclose(stats['Closed'], [424.4, 0, 0]))
+
+    def test_baseline_pickle(self):
+        self.check_values(self.portfolio)
+        self.assertEqual(len(self.portfolio.position_list), 6)
+
+    def test_remove_position(self):
+        # The second trade of 2024-02-01 must be found in the rebuilt ledger
+        self.portfolio.remove_position(3)
+        self.assertEqual(self.portfolio.asset_list[0].get_count('2024-02-01'), 15)
+
+    def test_round_trip(self):
+        for format in ['pickle', 'dir']:
+            name = os.path.join(self.tmp, format)
+            self.portfolio.save(name, format = format)
+            loaded = AssetUtils.AssetPortfolio(None, '2000-01-01').load(name)
+            self.check_values(loaded)
+            pd.testing.assert_frame_equal(loaded.get_position_list(), self.portfolio.get_position_list(),
+                                          check_dtype = False)
+
+    def test_unsupported_directory_version(self):
+        name = os.path.join(self.tmp, 'dir')
+        self.portfolio.save(name)
+        manifest_path = os.path.join(name, 'manifest.json')
+        with open(manifest_path, encoding = 'utf-8') as f:
+            manifest = json.load(f)
+        manifest['version'] = 1
+        with open(manifest_path, 'w', encoding = 'utf-8') as f:
+            json.dump(manifest, f)
+        with self.assertRaises(ValueError):
+            AssetUtils.AssetPortfolio(None, '2000-01-01').load(name)
+
+
+class PortfolioStatsTest(unittest.TestCase):
+
+    def test_stats_without_trades(self):
+        # A fresh portfolio, then one with a fee only
+        portfolio = AssetUtils.AssetPortfolio(None, '2000-01-01')
+        portfolio.load(os.path.join(FIXTURES, 'baseline_portfolio'))
+        for n in reversed(range(len(portfolio.position_list))):
+            if portfolio.position_list[n].type() != 'fee':
+                portfolio.remove_position(n)
+        for stats in [portfolio.get_weekly_stats(), portfolio.get_monthly_stats(), portfolio.get_annual_stats()]:
+            self.assertTrue((stats['Invested'] == 0).all())
+            self.assertTrue(stats['Adjusted portfolio result %'].isna().all())
+        portfolio.remove_position(0)
+        self.assertEqual(len(portfolio.get_monthly_stats()), 3)
+
+
+class PortfolioUpdateTest(unittest.TestCase):
+
+    def test_failed_asset(self):
+        db = CountingDatabase()
+        db.failing.add('b')
+        portfolio = AssetUtils.AssetPortfolio(db, '2024-06-03')
+        for id in ['a', 'b', 'c']:
+            portfolio.add_asset(id)
+        today = pd.to_datetime(date.today())
+        report = portfolio.update(workers = 3).set_index('id')
+        self.assertEqual(report['status'].to_dict(), {'a': 'updated', 'b': 'error', 'c': 'updated'})
+        self.assertIn('could not be downloaded', report.loc['b', 'error'])
+        self.assertEqual([asset.last_updated for asset in portfolio.asset_list],
+                         [today, pd.Timestamp('2024-06-02'), today])
+        self.assertFalse(np.isnan(portfolio.asset_list[2].get_price(today)))
+        self.assertEqual(portfolio.last_updated, pd.Timestamp('2024-06-03'))
+
+        # The next update fetches the failed asset only
+        db.failing.clear()
+        report = portfolio.update().set_index('id')
+        self.assertEqual(report['status'].to_dict(), {'a': 'up to date', 'b': 'updated', 'c': 'up to date'})
+        self.assertEqual(portfolio.last_updated, today)
+        self.assertEqual([len(db.fetched(id)) for id in ['a', 'b', 'c']], [1, 2, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
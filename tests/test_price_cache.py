@@ -0,0 +1,134 @@
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import AssetUtils
+import run_benchmarks
+
+T = pd.Timestamp
+price_history = run_benchmarks.price_history
+
+
+class Fetch:
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, id, start_date, end_date):
+        self.calls.append((start_date, end_date))
+        return price_history(start_date, end_date)
+
+
+class PriceCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'prices.sqlite')
+        self.cache = AssetUtils.PriceCache(self.path, ttl = pd.Timedelta(hours = 12), recent_days = 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def store(self, start_date, end_date, fetched, id = 'a'):
+        self.cache.store(id, T(start_date), T(end_date), price_history(start_date, end_date), T(fetched))
+
+    def ranges(self, id = 'a'):
+        con = sqlite3.connect(self.path)
+        try:
+            rows = con.execute('SELECT range_start, range_end FROM ranges WHERE id = ? ORDER BY range_start',
+                               (id,)).fetchall()
+        finally:
+            con.close()
+        return rows
+
+    def test_gaps(self):
+        self.store('2024-01-01', '2024-01-10', '2024-03-01')
+        self.store('2024-01-20', '2024-01-31', '2024-03-01')
+        now = T('2024-03-01 01:00')
+        self.assertEqual(self.cache.missing('a', '2024-01-01', '2024-02-10', now),
+                         [(T('2024-01-11'), T('2024-01-19')), (T('2024-02-01'), T('2024-02-10'))])
+        self.assertEqual(self.cache.missing('a', '2024-01-05', '2024-01-08', now), [])
+        self.assertEqual(self.cache.missing('a', '2023-12-25', '2024-01-03', now),
+                         [(T('2023-12-25'), T('2023-12-31'))])
+        self.assertEqual(self.cache.missing('b', '2024-01-01', '2024-01-02', now),
+                         [(T('2024-01-01'), T('2024-01-02'))])
+
+    def test_recent_days_after_ttl(self):
+        self.store('2024-01-01', '2024-01-10', '2024-01-10 12:00')
+        # Trusted up to the fetch while fresh, then up to recent_days before it
+        self.assertEqual(self.cache.covered('a', T('2024-01-10 20:00')), [(T('2024-01-01'), T('2024-01-10'))])
+        self.assertEqual(self.cache.covered('a', T('2024-01-11 01:00')), [(T('2024-01-01'), T('2024-01-07'))])
+        self.assertEqual(self.cache.missing('a', '2024-01-01', '2024-01-12', T('2024-01-11 01:00')),
+                         [(T('2024-01-08'), T('2024-01-12'))])
+
+    def test_get_fetches_gaps_only(self):
+        fetch = Fetch()
+        prices_df = self.cache.get('a', T('2024-01-01'), T('2024-01-31'), fetch)
+        self.assertEqual(fetch.calls, [(T('2024-01-01'), T('2024-01-31'))])
+        pd.testing.assert_frame_equal(prices_df, price_history('2024-01-01', '2024-01-31'), check_freq = False,
+                                      check_index_type = False)
+        prices_df = self.cache.get('a', T('2024-01-15'), T('2024-02-15'), fetch)
+        self.assertEqual(fetch.calls[1:], [(T('2024-02-01'), T('2024-02-15'))])
+        pd.testing.assert_frame_equal(prices_df, price_history('2024-01-15', '2024-02-15'), check_freq = False,
+                                      check_index_type = False)
+        self.cache.get('a', T('2024-01-10'), T('2024-02-10'), fetch)
+        self.assertEqual(len(fetch.calls), 2)
+        self.assertEqual(self.ranges(), [('2024-01-01', '2024-02-15')])
+
+    def test_failed_fetch_is_not_stored(self):
+        self.assertIsNone(self.cache.get('a', T('2024-01-01'), T('2024-01-31'), lambda *args: None))
+        self.assertEqual(self.ranges(), [])
+        self.assertEqual(len(self.cache.load('a', T('2024-01-01'), T('2024-01-31'))), 0)
+
+    def test_invalidate(self):
+        self.store('2024-01-01', '2024-01-31', '2024-03-01')
+        self.store('2024-01-01', '2024-01-31', '2024-03-01', id = 'b')
+        now = T('2024-03-01 01:00')
+        self.cache.invalidate('a', since = '2024-01-20')
+        self.assertEqual(self.cache.covered('a', now), [(T('2024-01-01'), T('2024-01-19'))])
+        self.assertEqual(self.cache.load('a', T('2024-01-01'), T('2024-01-31'))['date'].max(), T('2024-01-19'))
+        self.assertEqual(self.cache.covered('b', now), [(T('2024-01-01'), T('2024-01-31'))])
+        self.cache.invalidate(since = '2024-01-10')
+        self.assertEqual(self.cache.covered('b', now), [(T('2024-01-01'), T('2024-01-09'))])
+        self.cache.invalidate('a')
+        self.assertEqual(self.cache.covered('a', now), [])
+        self.assertEqual(len(self.cache.load('b', T('2024-01-01'), T('2024-01-31'))), 7)
+
+    def test_daily_updates_keep_one_range(self):
+        # Each day the recent days of the day before are fetched again
+        self.store('2024-01-01', '2024-01-10', '2024-01-10 18:00')
+        for day in pd.date_range('2024-01-11', '2024-01-20'):
+            now = day + pd.Timedelta(hours = 18)
+            gaps = self.cache.missing('a', '2024-01-01', day, now)
+            self.assertEqual(gaps, [(day - pd.Timedelta(days = 3), day)])
+            self.store(gaps[0][0], gaps[0][1], now)
+        self.assertEqual(self.ranges(), [('2024-01-01', '2024-01-20')])
+
+    def test_recent_days_are_not_merged(self):
+        # An adjacent range fetched while the first is fresh does not cover
+        # its recent days, which must be fetched again after the ttl
+        self.store('2024-01-01', '2024-01-10', '2024-01-10 12:00')
+        self.store('2024-01-11', '2024-01-12', '2024-01-10 18:00')
+        self.assertEqual(len(self.ranges()), 2)
+        self.assertEqual(self.cache.missing('a', '2024-01-01', '2024-01-12', T('2024-01-11 02:00')),
+                         [(T('2024-01-08'), T('2024-01-10'))])
+
+    def test_settled_ranges_are_merged(self):
+        self.store('2024-01-11', '2024-01-20', '2024-03-01')
+        self.store('2024-02-01', '2024-02-05', '2024-03-01')
+        self.store('2024-01-01', '2024-01-10', '2024-03-01')
+        self.assertEqual(self.ranges(), [('2024-01-01', '2024-01-20'), ('2024-02-01', '2024-02-05')])
+        self.store('2024-01-15', '2024-02-03', '2024-03-01')
+        self.assertEqual(self.ranges(), [('2024-01-01', '2024-02-05')])
+
+
+if __name__ == '__main__':
+    unittest.main()
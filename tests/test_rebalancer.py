@@ -0,0 +1,96 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import AssetUtils
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def objective(asset_prices, multipliers, target_distr, target_price, x):
+    # x holds counts in steps of 1 / multiplier, one column per candidate
+    return np.linalg.norm(asset_prices[:, None] * x / multipliers[:, None] / target_price - target_distr[:, None],
+                          axis = 0)
+
+
+def brute_force(asset_prices, multipliers, target_distr, target_price):
+    # Every grid point from zero to a step past the whole target in one asset
+    grids = []
+    for price, multiplier in zip(asset_prices, multipliers):
+        top = 5 if price == 0 else int(np.ceil(target_price * multiplier / price)) + 1
+        grids.append(np.arange(top + 1))
+    x = np.array([grid.ravel() for grid in np.meshgrid(*grids)])
+    return objective(asset_prices, multipliers, target_distr, target_price, x).min()
+
+
+class SolveTest(unittest.TestCase):
+
+    def check(self, asset_prices, multipliers, target_distr, target_price):
+        asset_prices = np.array(asset_prices, dtype = float)
+        multipliers = np.array(multipliers)
+        target_distr = np.array(target_distr)
+        x = AssetUtils.Rebalancer()._solve(asset_prices, multipliers, target_distr * target_price)
+        grid_x = x * multipliers
+        self.assertTrue(np.allclose(grid_x, np.round(grid_x)))
+        self.assertTrue((x[asset_prices == 0] == 0).all())
+        best = brute_force(asset_prices, multipliers, target_distr, target_price)
+        self.assertLessEqual(objective(asset_prices, multipliers, target_distr, target_price, grid_x[:, None])[0],
+                             best + 10 ** -12)
+
+    def test_matches_brute_force(self):
+        rng = np.random.default_rng(1)
+        for _ in range(200):
+            n_assets = rng.integers(1, 4)
+            asset_prices = rng.integers(1, 60, n_assets) * rng.choice([1, 0.25], n_assets)
+            multipliers = rng.choice([1, 10], n_assets)
+            target_distr = rng.dirichlet(np.ones(n_assets))
+            self.check(asset_prices, multipliers, target_distr, rng.integers(20, 150))
+
+    def test_fractional_counts(self):
+        self.check([7.3, 19.9], [10, 1], [0.45, 0.55], 100)
+        self.check([3.1, 0.7], [10, 10], [0.5, 0.5], 10)
+
+    def test_zero_prices(self):
+        self.check([0, 12.5, 30], [1, 1, 10], [0.2, 0.3, 0.5], 120)
+        self.check([0, 0], [1, 10], [0.5, 0.5], 100)
+
+
+class RebalanceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.portfolio = AssetUtils.AssetPortfolio(None, '2000-01-01')
+        self.portfolio.load(os.path.join(FIXTURES, 'baseline_portfolio'))
+        self.rebalancer = AssetUtils.Rebalancer()
+
+    def check_batch(self, target_distrs, refills):
+        batch = self.rebalancer.rebalance_batch(self.portfolio, target_distrs, refills)
+        ids = [asset.id for asset in self.portfolio.asset_list]
+        for i, (target_distr, refill) in enumerate(zip(target_distrs, refills)):
+            single = self.rebalancer.rebalance(self.portfolio, target_distr, refill = refill)
+            self.assertEqual(batch.loc[i, ids].tolist(), single['Rebalanced count'].tolist())
+            self.assertEqual(batch.loc[i, 'Refill'], refill)
+
+    def test_batch_rows_match_rebalance(self):
+        self.check_batch([[0.3, 0.7], [0.5, 0.5], [1, 0], [0.64, 0.36]], [100, 0, 250.5, -300])
+
+    def test_batch_rows_match_rebalance_with_fractional_counts(self):
+        self.portfolio.buy('etfb', '2024-03-29', 109.9, 0.4375, 0)
+        self.check_batch([[0.3, 0.7], [0.55, 0.45]], [0, 1000])
+        counts = self.rebalancer.rebalance_batch(self.portfolio, [[0.3, 0.7]], 0).loc[0, 'etfb']
+        self.assertNotEqual(counts % 1, 0)
+
+    def test_rounding_of_the_distribution(self):
+        # 0.7 * 3 / 3 is 0.6999999999999998; both methods accept it
+        target_distr = [0.3, 0.7 * 3 / 3]
+        self.assertNotEqual(sum(target_distr), 1)
+        self.check_batch([target_distr], [0])
+        self.assertRaises(Exception, self.rebalancer.rebalance, self.portfolio, [0.3, 0.6])
+        self.assertRaises(Exception, self.rebalancer.rebalance_batch, self.portfolio, [[0.3, 0.6]])
+
+
+if __name__ == '__main__':
+    unittest.main()
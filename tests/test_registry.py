@@ -0,0 +1,119 @@
+import os
+import sys
+import time
+import threading
+import unittest
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import AssetUtils
+import run_benchmarks
+
+
+class CountingDatabase(run_benchmarks.ReplayDatabase):
+
+    # Every fetch is recorded; ids in `failing` are not downloaded
+    def __init__(self, delay = 0):
+        run_benchmarks.ReplayDatabase.__init__(self)
+        self.delay = delay
+        self.failing = set()
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def retrieve_asset_historical(self, id, start_date, end_date):
+        with self._lock:
+            self.calls.append((id, pd.Timestamp(start_date)))
+        time.sleep(self.delay)
+        if id in self.failing:
+            return None
+        return run_benchmarks.ReplayDatabase.retrieve_asset_historical(self, id, start_date, end_date)
+
+    def fetched(self, id):
+        return [start_date for call_id, start_date in self.calls if call_id == id]
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = AssetUtils.AssetRegistry()
+        previous = AssetUtils.set_registry(self.registry)
+        self.addCleanup(AssetUtils.set_registry, previous)
+        self.today = pd.to_datetime(date.today())
+
+    def make_portfolio(self, db, ids):
+        portfolio = AssetUtils.AssetPortfolio(db, '2024-06-03')
+        for id in ids:
+            portfolio.add_asset(id)
+        return portfolio
+
+    def test_concurrent_updates_fetch_once(self):
+        db = CountingDatabase(delay = 0.05)
+        series = self.registry.get('a', db, '2024-06-03')
+        barrier = threading.Barrier(8)
+        results = []
+
+        def update():
+            barrier.wait()
+            results.append(series.update())
+
+        threads = [threading.Thread(target = update) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(db.fetched('a'), [pd.Timestamp('2024-06-02')])
+        self.assertEqual(sorted(results), [False] * 7 + [True])
+
+    def test_shared_assets_fetch_once(self):
+        db = CountingDatabase(delay = 0.01)
+        portfolios = [self.make_portfolio(db, ['a', 'b']), self.make_portfolio(db, ['a', 'c'])]
+        self.assertIs(portfolios[0].asset_list[0].series, portfolios[1].asset_list[0].series)
+        report = self.registry.update_all(portfolios, workers = 4)
+        self.assertEqual(sorted(report['id']), ['a', 'b', 'c'])
+        self.assertEqual(len(db.fetched('a')), 1)
+
+    def test_failed_assets_hold_back_their_portfolios(self):
+        db = CountingDatabase()
+        db.failing.add('c')
+        portfolios = [self.make_portfolio(db, ['a', 'b']), self.make_portfolio(db, ['a', 'c'])]
+        report = self.registry.update_all(portfolios, workers = 4)
+        self.assertEqual(report.set_index('id')['status'].to_dict(), {'a': 'updated', 'b': 'updated', 'c': 'error'})
+        self.assertEqual(portfolios[0].last_updated, self.today)
+        self.assertEqual(portfolios[1].last_updated, pd.Timestamp('2024-06-03'))
+
+        # The next run retries the failed asset only
+        db.failing.clear()
+        report = self.registry.update_all(portfolios, workers = 4)
+        self.assertEqual(report.set_index('id')['status'].to_dict(), {'a': 'up to date', 'c': 'updated'})
+        self.assertEqual(portfolios[1].last_updated, self.today)
+        self.assertEqual([len(db.fetched(id)) for id in ['a', 'b', 'c']], [1, 1, 2])
+
+    def test_earlier_start_refetches(self):
+        db = CountingDatabase()
+        series = self.registry.get('a', db, '2024-06-03')
+        self.assertTrue(series.update())
+        self.assertIs(self.registry.get('a', db, '2024-07-01'), series)
+        self.assertFalse(series.update())
+        self.assertIs(self.registry.get('a', db, '2024-03-01'), series)
+        self.assertTrue(series.update())
+        self.assertEqual(db.fetched('a'), [pd.Timestamp('2024-06-02'), pd.Timestamp('2024-02-29')])
+        self.assertEqual(series.first_date, pd.Timestamp('2024-03-01'))
+        self.assertEqual(series.get_prices(['2024-03-04'])[0],
+                         round(run_benchmarks.quote(pd.Timestamp('2024-03-04')), 2))
+        self.assertFalse(np.isnan(series.get_prices([self.today])[0]))
+
+    def test_unused_series_are_dropped(self):
+        db = CountingDatabase()
+        portfolio = self.make_portfolio(db, ['a'])
+        self.assertIn('a', self.registry)
+        del portfolio
+        self.assertNotIn('a', self.registry)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+import os
+import sys
+import time
+import threading
+import unittest
+from unittest import mock
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import AssetUtils
+
+
+class Response:
+
+    def __init__(self, status_code = 200, headers = None, content = b''):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = content
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Session:
+
+    # Answers with the given responses in turn; exceptions are raised
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.calls = 0
+
+    def get(self, url, **kwargs):
+        answer = self.answers[min(self.calls, len(self.answers) - 1)]
+        self.calls += 1
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+def make_scheduler(session, **kwargs):
+    kwargs.setdefault('rate', 10 ** 6)
+    kwargs.setdefault('burst', 10 ** 6)
+    scheduler = AssetUtils.RequestScheduler(**kwargs)
+    scheduler._session = session
+    return scheduler
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(AssetUtils.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retries_until_success(self):
+        failed = [Response(503), Response(502)]
+        session = Session(failed[0], requests.ConnectionError(), failed[1], Response(200))
+        scheduler = make_scheduler(session, retries = 4, backoff = 0.5, max_backoff = 30)
+        r = scheduler.get('http://example.com/page')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(session.calls, 4)
+        # Discarded responses release their connections
+        self.assertTrue(all(r.closed for r in failed))
+        # Full jitter: the n-th delay is at most backoff * 2 ** n
+        delays = [call.args[0] for call in self.sleep.call_args_list]
+        self.assertEqual(len(delays), 3)
+        for attempt, delay in enumerate(delays):
+            self.assertTrue(0 <= delay <= 0.5 * 2 ** attempt)
+
+    def test_raises_after_last_retry(self):
+        session = Session(Response(503))
+        scheduler = make_scheduler(session, retries = 2)
+        with self.assertRaises(requests.HTTPError) as context:
+            scheduler.get('http://example.com/page')
+        self.assertEqual(context.exception.response.status_code, 503)
+        self.assertEqual(session.calls, 3)
+        self.assertEqual(self.sleep.call_count, 2)
+
+    def test_client_errors_are_not_retried(self):
+        session = Session(Response(404))
+        scheduler = make_scheduler(session, retries = 2)
+        self.assertEqual(scheduler.get('http://example.com/page').status_code, 404)
+        self.assertEqual(session.calls, 1)
+
+    def test_retry_after(self):
+        session = Session(Response(429, {'Retry-After': '7'}), Response(503, {'Retry-After': '600'}), Response(200))
+        scheduler = make_scheduler(session, retries = 4, backoff = 0.01, max_backoff = 30)
+        scheduler.get('http://example.com/page')
+        self.assertEqual([call.args[0] for call in self.sleep.call_args_list], [7, 30])
+
+    def test_backoff_is_capped(self):
+        scheduler = make_scheduler(Session(), backoff = 1, max_backoff = 3)
+        self.assertTrue(all(0 <= scheduler._get_delay(10, None) <= 3 for _ in range(100)))
+        # HTTP dates are not parsed; the jittered backoff is used instead
+        delay = scheduler._get_delay(0, Response(503, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}))
+        self.assertTrue(0 <= delay <= 1)
+
+
+class SlotTest(unittest.TestCase):
+
+    def check_released(self, error):
+        session = Session(error, Response(200))
+        scheduler = make_scheduler(session, retries = 0, max_concurrency = 1)
+        with self.assertRaises(type(error)):
+            scheduler.get('http://example.com/page')
+        self.assertEqual(scheduler._active, 0)
+        # With the slot lost this would wait forever
+        thread = threading.Thread(target = scheduler.get, args = ('http://example.com/page',), daemon = True)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_slot_released_on_request_errors(self):
+        for error in [requests.exceptions.ChunkedEncodingError(), requests.exceptions.ContentDecodingError(),
+                      requests.TooManyRedirects(), requests.exceptions.InvalidURL()]:
+            self.check_released(error)
+
+    def test_slot_released_on_other_errors(self):
+        self.check_released(ValueError('bug in a hook'))
+
+    def test_concurrency_halves_on_errors(self):
+        scheduler = make_scheduler(Session(Response(503)), retries = 0, max_concurrency = 8)
+        with self.assertRaises(requests.HTTPError):
+            scheduler.get('http://example.com/page')
+        self.assertEqual(scheduler._limit, 4)
+        scheduler._session = Session(Response(200))
+        scheduler.get('http://example.com/page')
+        self.assertEqual(scheduler._limit, 4.25)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        scheduler = make_scheduler(Session(Response(200)), rate = 20, burst = 5)
+        start = time.monotonic()
+        for _ in range(5):
+            scheduler._take_token('example.com')
+        self.assertLess(time.monotonic() - start, 0.04)
+        for _ in range(4):
+            scheduler._take_token('example.com')
+        self.assertGreaterEqual(time.monotonic() - start, 4 / 20 * 0.9)
+
+    def test_hosts_have_separate_buckets(self):
+        scheduler = make_scheduler(Session(Response(200)), rate = 1, burst = 1)
+        start = time.monotonic()
+        scheduler._take_token('a.example.com')
+        scheduler._take_token('b.example.com')
+        self.assertLess(time.monotonic() - start, 0.5)
+
+
+class Clock:
+
+    # Stands in for time.perf_counter and time.sleep
+    def __init__(self):
+        self.now = 0.0
+
+    def perf_counter(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class SlowSession(Session):
+
+    def __init__(self, clock, *answers):
+        Session.__init__(self, *answers)
+        self.clock = clock
+
+    def get(self, url, **kwargs):
+        self.clock.sleep(0.25)
+        return Session.get(self, url, **kwargs)
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        for name in ['perf_counter', 'sleep']:
+            patcher = mock.patch.object(AssetUtils.time, name, getattr(self.clock, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.instrumentation = AssetUtils.Instrumentation()
+        previous = AssetUtils.set_instrumentation(self.instrumentation)
+        self.addCleanup(AssetUtils.set_instrumentation, previous)
+
+    def metrics(self):
+        return self.instrumentation.as_dict()['metrics']
+
+    def test_latency_per_attempt(self):
+        # Backoff between the attempts is not latency
+        session = SlowSession(self.clock, Response(503, {'Retry-After': '7'}), requests.ConnectionError(),
+                              Response(200))
+        make_scheduler(session, retries = 4).get('http://example.com/page')
+        metrics = self.metrics()
+        self.assertEqual(metrics['http.latency']['count'], 3)
+        for key, value in [('total', 0.75), ('min', 0.25), ('max', 0.25)]:
+            self.assertAlmostEqual(metrics['http.latency'][key], value)
+        self.assertEqual(metrics['http.retries']['count'], 2)
+        self.assertNotIn('http.errors', metrics)
+        self.assertGreaterEqual(self.clock.now, 7.75)
+
+    def test_last_attempt_is_not_a_retry(self):
+        scheduler = make_scheduler(SlowSession(self.clock, Response(503)), retries = 2)
+        with self.assertRaises(requests.HTTPError):
+            scheduler.get('http://example.com/page')
+        metrics = self.metrics()
+        self.assertEqual(metrics['http.latency']['count'], 3)
+        self.assertEqual(metrics['http.retries']['count'], 2)
+        self.assertEqual(metrics['http.errors']['count'], 1)
+
+    def test_database_requests(self):
+        db = AssetUtils.AssetDatabase()
+        db.scheduler = make_scheduler(SlowSession(self.clock, Response(502), Response(200, content = b'<html/>')))
+        db._request('http://example.com/page')
+        metrics = self.metrics()
+        self.assertEqual(metrics['http.latency']['count'], 2)
+        self.assertEqual(metrics['http.retries']['count'], 1)
+        self.assertEqual(metrics['http.bytes']['total'], 7)
+
+
+if __name__ == '__main__':
+    unittest.main()